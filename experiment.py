@@ -10,17 +10,62 @@ This is a mess... Sorry!
 
 from console import ExperimentConsole
 
+import os
+import sys
+import time
+import random
+import signal
 import inspect
+import traceback
 
-from model.scheduler import Scheduler
-from model.system    import SpiNNakerSystem
-from model.top       import SpiNNakerTorus
+from model.scheduler  import Scheduler
+from model.scheduler  import TimingWheelScheduler
+from model.system     import SpiNNakerSystem
+from model.top        import SpiNNakerTorus
+from model.checkpoint import save_checkpoint
+from model.checkpoint import load_checkpoint
+from model.profiler   import Profiler
+from model.tracing    import Trace
+from model.parallel   import ParallelEngine
 
 
 class Simulation(object):
 	
 	# The simulator will run at 150MHz
 	
+	# The scheduler implementation to use: Scheduler or TimingWheelScheduler
+	SCHEDULER = Scheduler
+	
+	# Skip over cycles in which no packets are in flight? (Doesn't change the
+	# results.)
+	FAST_FORWARD = True
+	
+	# The number of worker processes to split the torus (its boards) between and
+	# simulate in parallel (see model/parallel.py) or None to simulate it in this
+	# process. The results are the same given a SEED (and S-ATA links) except that
+	# the measurers are run every PARALLEL_INTERVAL cycles, no checkpoints are
+	# taken and the scheduler's load and trace are not recorded. The run must
+	# start with no packets in flight (so not after run_forked()'s warm-up or from
+	# a checkpoint taken mid-run).
+	NUM_WORKERS = None
+	PARALLEL_INTERVAL = 100
+	
+	# The number of cycles between automatic checkpoints or None to disable them
+	CHECKPOINT_INTERVAL = 1000
+	
+	# The default number of seconds (wall-clock) run() may take before stopping
+	# early or None for no limit.
+	WALL_TIME_BUDGET = None
+	
+	# Record the time spent in each kind of task and write it to
+	# [prefix]profile.log at the end of the run? (Slows the simulation down.)
+	PROFILE = False
+	
+	# The number of recent events (packets injected, routed, dropped etc.) to keep
+	# in a trace which is written to [prefix]trace.log if the simulation fails or
+	# receives SIGUSR1. None to disable.
+	TRACE_LENGTH = 10000
+	
 	TIME_PHASE_PERIOD = 10000
 	
 	WIDTH  = 1
@@ -32,6 +77,17 @@ class Simulation(object):
 	# The FPGA accepts one packet every cycle... probably...
 	SATA_ACCEPT_PERIOD = 1
 	
+	# The number of packets' worth of bandwidth the S-ATA links may save up when
+	# modelled as token buckets (which allows fractional accept periods) or None
+	# to model them by polling every SATA_ACCEPT_PERIOD cycles.
+	SATA_BUCKET_SIZE = None
+	
+	# The number of cycles buffer credit takes to get back to the sending end of
+	# an S-ATA link or None for 0 (returning it straight away) or, when simulating
+	# in parallel (which needs at least one cycle), SATA_LATENCY as though it were
+	# carried back down the link.
+	SATA_CREDIT_LATENCY = None
+	
 	# S-ATA link probably negledgable but we have 6GBit/s
 	# link which is 1 150MHz cycle for 32bits and frames
 	# with 8 packets in are 12 32bit words so 12 cycles
@@ -56,16 +112,64 @@ class Simulation(object):
 	PACKET_PROB  = 0.01
 	DISTANCE_STD = None
 	
+	# The seed from which each chip's traffic is drawn (reproducibly) or None to
+	# draw all traffic from the (unseeded) random module
+	SEED = None
+	
 	
 	class StopExperiment(Exception):
 		pass
 	
 	
-	def __init__(self, resultfile_prefix=""):
+	def __init__(self, resultfile_prefix="", resume=False):
+		"""
+		If resume is True and a checkpoint file ([prefix]checkpoint.pickle) exists,
+		the simulation is restored from the checkpoint rather than started afresh.
+		"""
 		self.console = ExperimentConsole()
 		
+		self.resultfile_prefix   = resultfile_prefix
+		self.checkpoint_filename = "%scheckpoint.pickle"%resultfile_prefix
+		
+		# Was the simulation restored from a checkpoint? If so measurers must not
+		# write their headers again or reconfigure the (restored) model.
+		self.resumed = resume and os.path.exists(self.checkpoint_filename)
+		
+		# The lengths of the result files {name: length} when the checkpoint was
+		# saved. Anything written to them after that is discarded when resuming.
+		self.result_file_lengths = {}
+		
+		if self.resumed:
+			self.restore()
+		else:
+			self.initialise()
+		
+		# A set of functions which are expected to be generators which are initially
+		# called with an argument of a file to use to store results. The generator's
+		# .next() is called each time the clock advances (before any of the new
+		# clock cycle's tasks are executed). When fast-forwarding, it is called once
+		# for each span of idle cycles skipped, at the last cycle of the span (the
+		# cycles skipped are those since the previous call). When simulating in
+		# parallel, it is called every PARALLEL_INTERVAL cycles, once they have been
+		# simulated. At the end of the simulation, a StopExperiment is raised in the
+		# generator
+		self.measurements = []
+		for name, f in inspect.getmembers(self, predicate=inspect.ismethod):
+			if name.startswith("measurement_"):
+				self.measurements.append(f)
+	
+	
+	def initialise(self):
+		"""
+		Build the simulated system.
+		"""
 		with self.console.timer("Initialising simulation..."):
-			self.scheduler = Scheduler()
+			sata_credit_latency = Simulation.SATA_CREDIT_LATENCY
+			if sata_credit_latency is None:
+				sata_credit_latency = 0 if Simulation.NUM_WORKERS is None \
+				                      else Simulation.SATA_LATENCY
+			
+			self.scheduler = Simulation.SCHEDULER()
 			self.system    = SpiNNakerSystem( self.scheduler
 			                                , Simulation.TIME_PHASE_PERIOD)
 			self.torus     = SpiNNakerTorus( self.scheduler
@@ -85,47 +189,100 @@ class Simulation(object):
 			                               , Simulation.CORE_PERIOD
 			                               , Simulation.PACKET_PROB
 			                               , Simulation.DISTANCE_STD
+			                               , Simulation.SEED
+			                               , Simulation.SATA_BUCKET_SIZE
+			                               , sata_credit_latency
 			                               )
+			
+			if Simulation.FAST_FORWARD:
+				self.scheduler.idle_test = self.system.is_quiescent
+			
+			if Simulation.TRACE_LENGTH is not None:
+				self.scheduler.trace = Trace(Simulation.TRACE_LENGTH)
+	
+	
+	def dump_trace(self):
+		"""
+		Write the scheduler's trace (if any) to [prefix]trace.log.
+		"""
+		if self.scheduler.trace is not None:
+			with open("%strace.log"%self.resultfile_prefix, "w") as f:
+				self.scheduler.trace.dump(f)
+	
+	
+	def restore(self):
+		"""
+		Restore the simulation from the checkpoint file.
+		"""
+		with self.console.timer("Restoring checkpoint..."):
+			state = load_checkpoint(self.checkpoint_filename)
+			self.scheduler = state["scheduler"]
+			self.system    = state["system"]
+			self.torus     = state["torus"]
+			random.setstate(state["random_state"])
+			self.result_file_lengths = state["result_file_lengths"]
+	
+	
+	def checkpoint(self, result_files):
+		"""
+		Save the state of the simulation to the checkpoint file along with the
+		lengths of the given {name: file} result files.
+		"""
+		result_file_lengths = {}
+		for name, f in result_files.iteritems():
+			f.flush()
+			result_file_lengths[name] = f.tell()
 		
-		self.resultfile_prefix = resultfile_prefix
-		
-		# A set of functions which are expected to be generators which are initially
-		# called with an argument of a file to use to store results. The generator's
-		# .next() is called every simulation cycle with a boolean indicating if the
-		# cycle was the first of a new clock cycle. At the end of the simulation,
-		# a StopExperiment is raised in the generator
-		self.measurements = []
-		for name, f in inspect.getmembers(self, predicate=inspect.ismethod):
-			if name.startswith("measurement_"):
-				self.measurements.append(f)
+		save_checkpoint(self.checkpoint_filename, {
+			"scheduler"           : self.scheduler,
+			"system"              : self.system,
+			"torus"               : self.torus,
+			"random_state"        : random.getstate(),
+			"result_file_lengths" : result_file_lengths,
+		})
 	
 	
 	def measurement_simulator_load(self, datafile):
 		"""
 		Measure the number of steps the simulator is executing for each clock cycle
+		(and the number of those which were due at the start of the cycle). The
+		scheduler records these itself and they are written out at the end.
 		"""
-		# Set up
-		datafile.write("#clock number_of_steps\n") 
-		yield
+		# Set up (the recording is restored along with the scheduler when resuming)
+		if not self.resumed:
+			datafile.write("#clock number_of_steps number_due\n") 
+			self.scheduler.record_load()
 		
-		# Measure how much work the simulator is doing
-		step = 0
 		try:
 			while True:
-				if (yield):
-					datafile.write("%d %d\n"%(self.scheduler.clock, step))
-					step = 0
-				else:
-					step += 1
+				yield
 		except Simulation.StopExperiment:
-			pass
-			# Nothing to write at the end of simulation
+			for clock, num_due, num_executed in self.scheduler.get_load():
+				datafile.write("%d %d %d\n"%(clock, num_executed, num_due))
 		
 	
 	
-	def run(self, num_clock_cycles):
-		# Get the iterator for the scheduler
-		it = self.scheduler.run()
+	def run(self, num_clock_cycles, wall_time_budget = None):
+		"""
+		Run the simulation until num_clock_cycles with the measurers writing their
+		results.
+		
+		The simulation stops early, at the end of the current cycle, if it has run
+		for wall_time_budget seconds (Simulation.WALL_TIME_BUDGET if None) or on
+		SIGTERM or SIGINT. The measurers are then finalised as usual, a line
+		recording the cycle reached is added to each result file and a checkpoint
+		(if enabled) is kept so that the run can be resumed. Returns True if the
+		run was completed. (When simulating in parallel, the simulation stops at
+		the end of the current PARALLEL_INTERVAL cycles and can't be resumed.)
+		"""
+		if wall_time_budget is None:
+			wall_time_budget = Simulation.WALL_TIME_BUDGET
+		deadline = None if wall_time_budget is None else time.time() + wall_time_budget
+		
+		# The parallel engine's model can't be checkpointed
+		checkpoint_interval = Simulation.CHECKPOINT_INTERVAL
+		if Simulation.NUM_WORKERS is not None:
+			checkpoint_interval = None
 		
 		# Start all the (measurer, file, name) and open their files
 		gen_files = []
@@ -134,35 +291,115 @@ class Simulation(object):
 			name = measurement.__name__.partition("measurement_")[2]
 			
 			# Open a file [prefix][function name].log to store the results of that
-			# measurer
-			f = open("%s%s.log"%(self.resultfile_prefix, name),"w")
+			# measurer (keeping the results written before the checkpoint when
+			# resuming)
+			filename = "%s%s.log"%(self.resultfile_prefix, name)
+			if name in self.result_file_lengths:
+				f = open(filename, "r+")
+				f.truncate(self.result_file_lengths[name])
+				f.seek(0, os.SEEK_END)
+			else:
+				f = open(filename, "w")
 			
 			# Start the measurer
 			with self.console.timer("Initialising measurer '%s'..."%name):
 				g = measurement(f)
 				g.next()
+				
+				# Checkpoints are taken just after the measurers have handled a clock
+				# edge so bring the measurer up to that point when resuming.
+				if self.resumed:
+					g.next()
 			
 			# Put the running measurer and its file into the dictionary...
 			gen_files.append((g, f, name))
 		
-		# Store the last observed clock value to allow us to detect when it changes
 		with self.console.timer("Running simulation...") as timer:
-			clock = 0
-			timer.set_progress(clock, num_clock_cycles)
+			timer.set_progress(self.scheduler.clock, num_clock_cycles)
+			
+			measurers    = [gen for gen, _, _ in gen_files]
+			result_files = dict((name, f) for _, f, name in gen_files)
+			
+			# The clock at the last progress update and checkpoint (in lists so that
+			# they can be updated by on_clock_edge). The clock may jump when
+			# fast-forwarding.
+			last_progress   = [self.scheduler.clock]
+			last_checkpoint = [self.scheduler.clock]
 			
-			# Run the experiment for the prescribed number of cycles
-			while it.next() < num_clock_cycles:
-				# Has the clock changed?
-				clock_changed = clock != self.scheduler.clock
+			# Has an early stop been requested? (In a list for the same reason.)
+			stopped = [False]
+			def stop():
+				stopped[0] = True
+				self.scheduler.stop()
+			
+			# Called by the scheduler every time the clock advances
+			def on_clock_edge():
 				clock = self.scheduler.clock
 				
 				# Some progress output
-				if (clock_changed and clock%10 == 0):
+				if clock - last_progress[0] >= 10:
 					timer.set_progress(clock, num_clock_cycles)
+					last_progress[0] = clock
+					
+					# Stop if out of time (checked no more often than the progress)
+					if deadline is not None and time.time() >= deadline:
+						stop()
+				
+				# Run each measurer (with sleeping routers' state up to date)
+				self.system.catch_up(clock)
+				for gen in measurers:
+					gen.next()
 				
-				# Run each measurer informing it if the clock changed
-				for gen, _, _ in gen_files:
-					gen.send(clock_changed)
+				# Checkpoint every CHECKPOINT_INTERVAL cycles
+				if checkpoint_interval is not None \
+				   and clock - last_checkpoint[0] >= checkpoint_interval:
+					self.checkpoint(result_files)
+					last_checkpoint[0] = clock
+			
+			if Simulation.PROFILE:
+				self.scheduler.profiler = Profiler()
+			
+			# Dump the trace on request and stop early when asked to terminate
+			old_handlers = {}
+			old_handlers[signal.SIGUSR1] = signal.signal(signal.SIGUSR1,
+			                                             (lambda signum, frame: self.dump_trace()))
+			for signum in (signal.SIGTERM, signal.SIGINT):
+				old_handlers[signum] = signal.signal(signum,
+				                                     (lambda signum, frame: stop()))
+			
+			# Run the experiment for the prescribed number of cycles, dumping the
+			# trace if anything goes wrong
+			try:
+				if Simulation.NUM_WORKERS is None:
+					self.scheduler.run_until(num_clock_cycles, on_clock_edge)
+				else:
+					self.run_parallel(num_clock_cycles, on_clock_edge)
+			except:
+				self.dump_trace()
+				raise
+			finally:
+				for signum, old_handler in old_handlers.iteritems():
+					signal.signal(signum, old_handler)
+			
+			# A stop requested in the final cycle is not taken up (or early)
+			if self.scheduler.stopping:
+				self.scheduler.stopping = False
+				stopped[0] = False
+			
+			# Account for the routing steps skipped by sleeping routers
+			self.system.catch_up(self.scheduler.clock + 1 if stopped[0]
+			                     else num_clock_cycles)
+			
+			# Keep a checkpoint (taken before the measurers are finalised) to resume
+			# the run from
+			if stopped[0] and checkpoint_interval is not None:
+				self.checkpoint(result_files)
+		
+		# Write the profile
+		if self.scheduler.profiler is not None:
+			with open("%sprofile.log"%self.resultfile_prefix, "w") as f:
+				self.scheduler.profiler.write_report(f)
+			self.scheduler.profiler = None
 		
 		# Terminate each measurer
 		for gen, f, name in gen_files:
@@ -171,8 +408,116 @@ class Simulation(object):
 					gen.throw(Simulation.StopExperiment())
 				except StopIteration:
 					pass
+				if stopped[0]:
+					f.write("#stopped early at cycle %d of %d\n"%(self.scheduler.clock,
+					                                               num_clock_cycles))
 				f.close()
 		
+		if stopped[0]:
+			return False
+		
+		# The results are complete, the checkpoint is no longer needed
+		if os.path.exists(self.checkpoint_filename):
+			os.remove(self.checkpoint_filename)
+		
+		return True
+	
+	
+	def run_parallel(self, num_clock_cycles, on_clock_edge):
+		"""
+		Simulate the torus in parallel (see NUM_WORKERS) until num_clock_cycles,
+		calling on_clock_edge every PARALLEL_INTERVAL cycles. Like
+		Scheduler.run_until(), returns early if the scheduler's stop() is called.
+		"""
+		engine = ParallelEngine( self.scheduler
+		                       , self.system
+		                       , self.torus
+		                       , Simulation.NUM_WORKERS
+		                       )
+		try:
+			while self.scheduler.clock + 1 < num_clock_cycles:
+				if self.scheduler.stopping:
+					self.scheduler.stopping = False
+					return
+				
+				engine.run_until(min(self.scheduler.clock + 1 + Simulation.PARALLEL_INTERVAL,
+				                     num_clock_cycles))
+				on_clock_edge()
+		finally:
+			engine.close()
+	
+	
+	def run_forked(self, warmup_cycles, num_clock_cycles, variants,
+	               max_processes = None, resume = False):
+		"""
+		Simulate a warm-up period of warmup_cycles once and then, for each of the
+		(resultfile_prefix, f) pairs in variants, fork a child process which calls
+		f(self) to change the simulation (e.g. router parameters or injection rates)
+		and then runs it until num_clock_cycles with its measurers writing to files
+		with the given prefix. The children share the warm-up state copy-on-write.
+		
+		The measurers are only started in the children, after the warm-up, so any
+		set-up they do to the model (e.g. changing the traffic, as
+		PacketTimeExperiment's do) is not in effect during the warm-up. Such changes
+		should be made before calling run_forked() instead.
+		
+		If resume is True, variants with a checkpoint ([prefix]checkpoint.pickle)
+		are restored from it rather than from the warm-up (which is skipped if
+		every variant has one).
+		
+		At most max_processes children are run at once (all at once if None).
+		Returns True if every variant completed successfully.
+		"""
+		resumed = set( resultfile_prefix for resultfile_prefix, f in variants
+		               if resume and os.path.exists("%scheckpoint.pickle"
+		                                            % resultfile_prefix))
+		
+		if len(resumed) < len(variants):
+			with self.console.timer("Warming up...") as timer:
+				timer.set_progress(self.scheduler.clock, warmup_cycles)
+				self.scheduler.run_until(warmup_cycles)
+		
+		running  = set()
+		failures = 0
+		for resultfile_prefix, f in variants:
+			# Wait for a child to finish if too many are running
+			while max_processes is not None and len(running) >= max_processes:
+				pid, status = os.wait()
+				running.discard(pid)
+				failures += status != 0
+			
+			# Don't let the children inherit unwritten output
+			sys.stdout.flush()
+			
+			pid = os.fork()
+			if pid == 0:
+				# Child: run the variant and exit without returning to the caller
+				status = 0
+				try:
+					self.resultfile_prefix   = resultfile_prefix
+					self.checkpoint_filename = "%scheckpoint.pickle"%resultfile_prefix
+					self.resumed = resultfile_prefix in resumed
+					if self.resumed:
+						self.restore()
+					else:
+						f(self)
+					if not self.run(num_clock_cycles):
+						status = 1
+				except:
+					traceback.print_exc()
+					status = 1
+				sys.stdout.flush()
+				os._exit(status)
+			running.add(pid)
+		
+		# Wait for the remaining children
+		while running:
+			pid, status = os.wait()
+			running.discard(pid)
+			failures += status != 0
+		
+		return failures == 0
+		
 
 
 if __name__=="__main__":
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+Saving and restoring the state of a simulation.
+
+Simulation state is simply pickled. Python 2 can't pickle bound methods (which
+the scheduler's queues are full of) so a reducer is registered for them which
+pickles the object and the method's name instead. Modules (e.g. the random
+module used by unseeded traffic generators) are pickled by name.
+"""
+
+import os
+import sys
+import types
+import copy_reg
+import importlib
+
+import cPickle as pickle
+
+
+def _reduce_method(method):
+	return (getattr, (method.im_self, method.im_func.__name__))
+
+copy_reg.pickle(types.MethodType, _reduce_method)
+
+
+def _reduce_module(module):
+	return (importlib.import_module, (module.__name__,))
+
+copy_reg.pickle(types.ModuleType, _reduce_module)
+
+
+# Models are deeply nested object graphs (e.g. chains of packets and links)
+RECURSION_LIMIT = 100000
+
+
+def save_checkpoint(filename, state):
+	"""
+	Pickle the given state into the named file. The file is replaced atomically
+	so an existing checkpoint survives a crash while saving.
+	"""
+	recursion_limit = sys.getrecursionlimit()
+	sys.setrecursionlimit(max(recursion_limit, RECURSION_LIMIT))
+	try:
+		with open(filename + ".tmp", "wb") as f:
+			pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+		os.rename(filename + ".tmp", filename)
+	finally:
+		sys.setrecursionlimit(recursion_limit)
+
+
+def load_checkpoint(filename):
+	"""
+	Unpickle the state saved in the named file by save_checkpoint().
+	"""
+	recursion_limit = sys.getrecursionlimit()
+	sys.setrecursionlimit(max(recursion_limit, RECURSION_LIMIT))
+	try:
+		with open(filename, "rb") as f:
+			return pickle.load(f)
+	finally:
+		sys.setrecursionlimit(recursion_limit)
@@ -4,12 +4,26 @@
 Processor core models.
 """
 
-from random import random
-from random import randint
-from random import normalvariate
+import random
+
+from math import log
+from math import ceil
+
+from random import Random
+
+from hashlib import md5
 
 from packet import SpiNNakerP2PPacket
 
+
+def stream_seed(seed, x, y):
+	"""
+	Derive the seed of the random number stream of the chip at (x, y) from the
+	seed of a run.
+	"""
+	return int(md5(repr((seed, x, y))).hexdigest(), 16)
+
+
 class SpiNNakerTrafficGenerator(object):
 	"""
 	A simple traffic generator which generates traffic a random intervals and
@@ -30,6 +44,7 @@ class SpiNNakerTrafficGenerator(object):
 	            , injection_link
 	            , exit_link
 	            , distance_std = None
+	            , seed = None
 	            ):
 		"""
 		clock_period is the number of scheduler ticks per clock cycle.
@@ -44,6 +59,11 @@ class SpiNNakerTrafficGenerator(object):
 		distance_std is the standard deviation of the distance along the X and Y
 		axes from the node a packet should be delivered. If None then a uniform
 		distribution will be used.
+		
+		seed is the seed of the run. If given, the generator draws from its own
+		stream of random numbers derived from the seed and its mesh position so
+		that its traffic doesn't depend on what any other generator does. If None
+		the random module is used.
 		"""
 		
 		self.scheduler = scheduler
@@ -61,6 +81,13 @@ class SpiNNakerTrafficGenerator(object):
 		self.mesh_dimensions = (1,1)
 		self.mesh_position   = (0,0)
 		
+		# The source of random numbers (reseeded when the position is set)
+		self.seed = seed
+		if seed is None:
+			self.random = random
+		else:
+			self.random = Random(stream_seed(seed, *self.mesh_position))
+		
 		# Statistic counters
 		self.counters = {
 			# Number of packets which were successfully injected
@@ -76,8 +103,73 @@ class SpiNNakerTrafficGenerator(object):
 			"generator_cycles" : 0,
 		}
 		
-		# Start the generator transmitting
-		self.scheduler.do_later(self.tick, self.clock_period)
+		# Start the generator transmitting (ticked in batches with the other
+		# generators)
+		self.scheduler.set_batch_handler(SpiNNakerTrafficGenerator.tick, tick_batch)
+		self.tick_task = self.scheduler.do_every(self.tick, self.clock_period,
+		                                         on_skip = self.skip_ticks)
+		
+		# The time of the first tick (injections only happen on ticks)
+		self.first_tick = self.scheduler.clock + self.clock_period
+		
+		# The time of the tick at which the next packet will be generated (None if
+		# none will be) and a Timer which goes off at that time.
+		self.next_injection  = None
+		self.injection_timer = None
+		self.schedule_injection()
+	
+	
+	def set_packet_prob(self, packet_prob):
+		"""
+		Change the probability of a packet being generated each cycle, taking
+		effect from the next tick.
+		"""
+		self.packet_prob = packet_prob
+		self.schedule_injection()
+	
+	
+	def schedule_injection(self):
+		"""
+		Schedule the generation of the next packet. Rather than trying to generate a
+		packet with probability packet_prob every tick, the number of ticks until
+		the next packet is drawn from the equivalent geometric distribution so that
+		ticks needn't do anything while the system is idle.
+		"""
+		if self.injection_timer is not None:
+			self.injection_timer.cancel()
+			self.injection_timer = None
+		
+		if self.packet_prob <= 0.0:
+			self.next_injection = None
+			return
+		
+		if self.packet_prob >= 1.0:
+			num_ticks = 1
+		else:
+			num_ticks = max(1, int(ceil(log(1.0 - self.random.random())
+			                            / log(1.0 - self.packet_prob))))
+		
+		# The next tick after now
+		clock = self.scheduler.clock
+		if clock < self.first_tick:
+			time = self.first_tick
+		else:
+			time = self.first_tick + ((clock - self.first_tick) // self.clock_period
+			                          + 1) * self.clock_period
+		
+		self.next_injection = time + (num_ticks - 1) * self.clock_period
+		
+		# Make sure the scheduler doesn't skip over the injection while idle
+		self.injection_timer = self.scheduler.set_timer(self.injection_due,
+		                                                self.next_injection - clock)
+	
+	
+	def injection_due(self):
+		"""
+		Does nothing: scheduled for the time of the next injection so that the
+		scheduler doesn't skip over it.
+		"""
+		pass
 	
 	
 	def set_mesh_dimensions(self, w, h):
@@ -92,6 +184,11 @@ class SpiNNakerTrafficGenerator(object):
 		Set the X and Y coordinates of the system the router is part of.
 		"""
 		self.mesh_position = (x,y)
+		
+		# Start our stream of random numbers afresh for our new position
+		if self.seed is not None:
+			self.random.seed(stream_seed(self.seed, x, y))
+			self.schedule_injection()
 	
 	
 	def get_random_dest(self):
@@ -100,10 +197,12 @@ class SpiNNakerTrafficGenerator(object):
 		"""
 		if self.distance_std is None:
 			# Uniform distribution
-			dest = tuple(randint(0, dimension-1) for dimension in self.mesh_dimensions)
+			dest = tuple(self.random.randint(0, dimension-1)
+			             for dimension in self.mesh_dimensions)
 		else:
 			# Normal distribution
-			dest = tuple(int(normalvariate(position, self.distance_std)) % dimension
+			dest = tuple(int(self.random.normalvariate(position, self.distance_std))
+			             % dimension
 			             for position, dimension
 			             in zip(self.mesh_position, self.mesh_dimensions))
 		return dest
@@ -121,32 +220,64 @@ class SpiNNakerTrafficGenerator(object):
 			packet = self.exit_link.receive()
 			# Add final meta-data
 			packet.receive_time = self.scheduler.clock
+			self.system.packets_in_flight -= 1
 			# Update counters
 			self.counters["generator_packets_received"] += 1
+			self.scheduler.trace_event(self, "received", packet)
 		
 		# Possibly send a packet out
-		if random() < self.packet_prob:
-			# Select the packet destination
-			dest = self.get_random_dest()
-			
-			# Send a packet with a reference to this object as a payload and the given
-			# destination.
-			packet = SpiNNakerP2PPacket(self.system, self, dest,
-			                            SpiNNakerTrafficGenerator.PACKET_LENGTH)
-			# Add meta-data
-			packet.source    = self.mesh_position
-			packet.send_time = self.scheduler.clock
-			
-			if not self.injection_link.can_send():
-				# Can't send so we must drop the packet!
-				packet.drop_time = self.scheduler.clock
-				packet.drop_location = self.mesh_position
-				self.counters["generator_dropped_packets"] += 1
-			else:
-				# Send the packet
-				self.injection_link.send(packet)
-				self.counters["generator_injected_packets"] += 1
-				
-		
-		# Schedule the next tick
-		self.scheduler.do_later(self.tick, self.clock_period)
+		if self.scheduler.clock == self.next_injection:
+			self.inject()
+	
+	
+	def skip_ticks(self, num_ticks):
+		"""
+		Account for num_ticks ticks skipped while no packets were in flight in the
+		system (and so nothing could have arrived).
+		"""
+		self.counters["generator_cycles"] += num_ticks
+	
+	
+	def inject(self):
+		"""
+		Generate a packet and send it out.
+		"""
+		# Select the packet destination
+		dest = self.get_random_dest()
+		
+		# Send a packet with a reference to this object as a payload and the given
+		# destination.
+		packet = SpiNNakerP2PPacket(self.system, self, dest,
+		                            SpiNNakerTrafficGenerator.PACKET_LENGTH)
+		# Add meta-data
+		packet.source    = self.mesh_position
+		packet.send_time = self.scheduler.clock
+		
+		if not self.injection_link.can_send():
+			# Can't send so we must drop the packet!
+			packet.drop_time = self.scheduler.clock
+			packet.drop_location = self.mesh_position
+			self.system.packets_in_flight -= 1
+			self.counters["generator_dropped_packets"] += 1
+			self.scheduler.trace_event(self, "dropped", packet)
+		else:
+			# Send the packet
+			self.injection_link.send(packet)
+			self.counters["generator_injected_packets"] += 1
+			self.scheduler.trace_event(self, "injected", packet)
+		
+		self.schedule_injection()
+
+
+def tick_batch(generators):
+	"""
+	Batch handler for SpiNNakerTrafficGenerator.tick (see
+	Scheduler.set_batch_handler()). Generators with nothing to receive or inject
+	only need their cycle counter updating.
+	"""
+	clock = generators[0].scheduler.clock
+	for generator in generators:
+		if generator.next_injection == clock or generator.exit_link.can_receive():
+			generator.tick()
+		else:
+			generator.counters["generator_cycles"] += 1
@@ -4,6 +4,9 @@
 Models of various types of link. The links are able to send Packet objects.
 """
 
+from collections import deque
+
+
 class Link(object):
 	"""
 	Base class for a Link.
@@ -11,6 +14,48 @@ class Link(object):
 	
 	def __init__(self, scheduler):
 		self.scheduler = scheduler
+		
+		# Optional callables (see set_arrival_listener() and set_space_listener())
+		self.arrival_listener = None
+		self.space_listener   = None
+	
+	
+	def set_arrival_listener(self, listener):
+		"""
+		Set a callable (or None) which is called when the link, having had nothing
+		to receive, is sent a value. It is called with the time the value can be
+		received (the current cycle if it can be received straight away) so that
+		the consumer can be scheduled only when it has something to do. A consumer
+		which stops polling while the link still holds values should check when
+		they can be received as no further call is made until the link is empty.
+		"""
+		self.arrival_listener = listener
+	
+	
+	def set_space_listener(self, listener):
+		"""
+		Set a callable (or None) which is called when the link, having been unable
+		to accept a value, is made able to by a value being received. It is called
+		with the time from which a value can be sent so that a blocked producer
+		need not poll. Links which never refuse a value never call it.
+		"""
+		self.space_listener = listener
+	
+	
+	def next_arrival_time(self):
+		"""
+		The time the value at the front of the link can (or could) be received or
+		None if there is no value in the link.
+		"""
+		return None
+	
+	
+	def next_free_time(self):
+		"""
+		The time from which a value can (or could) be sent down the link or None if
+		that isn't known until a value is received.
+		"""
+		return None
 	
 	
 	def can_send(self):
@@ -85,51 +130,87 @@ class SilistixLink(Link):
 		self.send_cycles = send_cycles
 		self.ack_cycles  = ack_cycles
 		
-		# State of the link
-		self.state = SilistixLink.READY
+		# The state the link was last put into by send() or receive() (READY,
+		# SENDING or ACKING) and the time at which it moves on by itself (SENDING
+		# to STABLE, ACKING to READY). The current state is derived from these and
+		# the clock so the link never needs to schedule anything.
+		self.last_state      = SilistixLink.READY
+		self.transition_time = None
 		
 		# Current packet being sent
 		self.cur_packet = None
 	
 	
+	def get_state(self):
+		"""
+		Get the current state of the link.
+		"""
+		if self.last_state != SilistixLink.READY \
+		   and self.scheduler.clock >= self.transition_time:
+			if self.last_state == SilistixLink.SENDING:
+				return SilistixLink.STABLE
+			else:
+				return SilistixLink.READY
+		return self.last_state
+	
+	
 	def can_send(self):
-		return self.state == SilistixLink.READY
+		return self.last_state == SilistixLink.READY \
+		       or (self.last_state == SilistixLink.ACKING
+		           and self.scheduler.clock >= self.transition_time)
 	
 	
 	def send(self, data):
-		assert(self.state == SilistixLink.READY)
+		assert(self.can_send())
 		
 		self.cur_packet = data
-		self.state = SilistixLink.SENDING
-		
-		def arrived():
-			self.state = SilistixLink.STABLE
+		self.last_state = SilistixLink.SENDING
+		self.transition_time = ( self.scheduler.clock
+		                       + self.send_cycles * data.length
+		                       + self.ack_cycles * (data.length-1)
+		                       )
 		
-		self.scheduler.do_later(arrived,
-		                        self.send_cycles * data.length
-		                        + self.ack_cycles * (data.length-1))
+		if self.arrival_listener is not None:
+			self.arrival_listener(self.transition_time)
+	
+	
+	def next_arrival_time(self):
+		if self.last_state == SilistixLink.SENDING:
+			return self.transition_time
+		else:
+			return None
+	
+	
+	def next_free_time(self):
+		if self.last_state == SilistixLink.READY:
+			return self.scheduler.clock
+		elif self.last_state == SilistixLink.ACKING:
+			return self.transition_time
+		else:
+			return None
 	
 	
 	def can_receive(self):
-		return self.state == SilistixLink.STABLE
+		return self.last_state == SilistixLink.SENDING \
+		       and self.scheduler.clock >= self.transition_time
 	
 	
 	def receive(self):
-		assert(self.state == SilistixLink.STABLE)
-		
-		self.state = SilistixLink.ACKING
+		assert(self.can_receive())
 		
-		def acked():
-			self.cur_packet = None
-			self.state = SilistixLink.READY
+		self.last_state = SilistixLink.ACKING
+		self.transition_time = self.scheduler.clock + self.ack_cycles
 		
-		self.scheduler.do_later(acked, self.ack_cycles)
+		if self.space_listener is not None:
+			self.space_listener(self.transition_time)
 		
-		return self.cur_packet
+		data = self.cur_packet
+		self.cur_packet = None
+		return data
 	
 	
 	def peek(self):
-		assert(self.state == SilistixLink.STABLE)
+		assert(self.can_receive())
 		
 		return self.cur_packet
 
@@ -150,34 +231,72 @@ class BufferLink(Link):
 		
 		self.buffer_length  = buffer_length
 		
-		# The buffer
-		self.packet_buffer = []
+		# The buffer: a ring of buffer_length slots whose num_packets occupied slots
+		# start at head or, if unlimited, a deque (whose head is always 0).
+		if buffer_length is None:
+			self.packet_buffer = deque()
+		else:
+			self.packet_buffer = [None] * buffer_length
+		self.head        = 0
+		self.num_packets = 0
+		
+		# The largest number of packets the buffer has held at once
+		self.high_water_mark = 0
 	
 	
 	def can_send(self):
-		return self.buffer_length is None or len(self.packet_buffer) < self.buffer_length
+		return self.buffer_length is None or self.num_packets < self.buffer_length
 	
 	
 	def send(self, data):
 		assert(self.can_send())
 		
-		self.packet_buffer.append(data)
+		if self.buffer_length is None:
+			self.packet_buffer.append(data)
+		else:
+			self.packet_buffer[(self.head + self.num_packets) % self.buffer_length] = data
+		
+		self.num_packets += 1
+		if self.num_packets > self.high_water_mark:
+			self.high_water_mark = self.num_packets
+		
+		if self.num_packets == 1 and self.arrival_listener is not None:
+			self.arrival_listener(self.scheduler.clock)
+	
+	
+	def next_arrival_time(self):
+		return self.scheduler.clock if self.num_packets else None
+	
+	
+	def next_free_time(self):
+		return self.scheduler.clock if self.can_send() else None
 	
 	
 	def can_receive(self):
-		return len(self.packet_buffer) >= 1
+		return self.num_packets >= 1
 	
 	
 	def receive(self):
 		assert(self.can_receive())
 		
-		return self.packet_buffer.pop(0)
+		if self.num_packets == self.buffer_length \
+		   and self.space_listener is not None:
+			self.space_listener(self.scheduler.clock)
+		
+		self.num_packets -= 1
+		if self.buffer_length is None:
+			return self.packet_buffer.popleft()
+		else:
+			data = self.packet_buffer[self.head]
+			self.packet_buffer[self.head] = None
+			self.head = (self.head + 1) % self.buffer_length
+			return data
 	
 	
 	def peek(self):
 		assert(self.can_receive())
 		
-		return self.packet_buffer[0]
+		return self.packet_buffer[self.head]
 
 
 
@@ -193,62 +312,64 @@ class DelayLineLink(Link):
 		"""
 		latency is the number of cycles between a packet being sent and it arriving.
 		"""
-		self.scheduler = scheduler
-		self.latency   = latency
+		Link.__init__(self, scheduler)
 		
-		# A buffer of [packet, cycles_until_received] pairs
-		self.packet_buffer = []
+		self.latency = latency
 		
-		# Start the decrementer running
-		self.scheduler.do_later(self.decrement_counters, 1)
+		# A buffer of (arrival_time, packet) pairs in the order sent. A packet sent
+		# in cycle t can be received from cycle t + latency + 1.
+		self.packet_buffer = deque()
+	
 	
+	def can_send(self):
+		# No bandwidth limits
+		return True
 	
-	def decrement_counters(self):
+	
+	def send(self, data):
+		self.deliver(data, self.scheduler.clock)
+	
+	
+	def deliver(self, data, send_time):
 		"""
-		Decrement the latency counters on all packets
+		Add a packet to the line as if it had been sent at send_time (e.g. a packet
+		passed on by another process simulating the sending end). Packets must be
+		delivered in the order they were sent.
 		"""
-		# Make a local copy of the packet buffer (so that we can know what elements
-		# are in the buffer "right now")
-		packet_buffer_copy = self.packet_buffer[:]
+		arrival_time = send_time + self.latency + 1
+		self.packet_buffer.append((arrival_time, data))
 		
-		# At the end of the cycle, decrement all these counters
-		def later():
-			for pair in packet_buffer_copy:
-				pair[1] -= 1
-		self.scheduler.do_later(later)
-		
-		# Reschedule the decrementer
-		self.scheduler.do_later(self.decrement_counters, 1)
+		if len(self.packet_buffer) == 1 and self.arrival_listener is not None:
+			self.arrival_listener(arrival_time)
 	
 	
-	def can_send(self):
-		# No bandwidth limits
-		return True
+	def next_arrival_time(self):
+		"""
+		The time the packet at the front of the line can be received or None if
+		the line is empty.
+		"""
+		return self.packet_buffer[0][0] if self.packet_buffer else None
 	
 	
-	def send(self, data):
-		# Add the packet to the buffer at the end of the cycle (so its latency
-		# counter isn't decremented until the next cycle).
-		def later():
-			self.packet_buffer.append([data, self.latency])
-		self.scheduler.do_later(later)
+	def next_free_time(self):
+		return self.scheduler.clock
 	
 	
 	def can_receive(self):
-		# Is there anything in the buffer and has the counter reached zero for the
-		# first entry?
-		return self.packet_buffer and self.packet_buffer[0][1] <= 0
+		# Is there anything in the buffer and has the first entry arrived?
+		return bool(self.packet_buffer) \
+		       and self.packet_buffer[0][0] <= self.scheduler.clock
 	
 	
 	def receive(self):
 		assert(self.can_receive())
-		packet, _ = self.packet_buffer.pop(0)
+		_, packet = self.packet_buffer.popleft()
 		return packet
 	
 	
 	def peek(self):
 		assert(self.can_receive())
-		packet, _ = self.packet_buffer[0]
+		_, packet = self.packet_buffer[0]
 		return packet
 
 
@@ -275,7 +396,14 @@ class SATALink(Link):
 	the receiving end.
 	
 	This model does not account for link errors and acknowledgements (except
-	indirectly if generous latency specifications are given).
+	indirectly if generous latency specifications are given). Buffer credit is
+	returned to the sending end sata_credit_latency cycles after a packet leaves
+	the delay line (straight away by default).
+	
+	The handler sleeps while every channel is empty or only has packets in
+	transit, waking when the next of these can be received or a packet is sent
+	into the link. It is called at the same times as if it ran every period
+	whenever it has something to do.
 	"""
 	
 	def __init__( self
@@ -286,6 +414,8 @@ class SATALink(Link):
 	            , sata_latency
 	            , silistix_send_cycles
 	            , silistix_ack_cycles
+	            , sata_bucket_size = None
+	            , sata_credit_latency = 0
 	            ):
 		"""
 		num_channels is the number of channels supported by the link.
@@ -305,12 +435,50 @@ class SATALink(Link):
 		silistix_send_cycles see SilistixLink.
 		
 		silistix_ack_cycles see SilistixLink.
+		
+		sata_bucket_size selects a token-bucket model of the bandwidth if not None.
+		Rather than handling at most one packet in and one out each
+		sata_accept_period cycles, the link earns one packet's worth of bandwidth
+		in each direction every sata_accept_period cycles (which may be
+		fractional), saving up to sata_bucket_size packets' worth. The handler
+		runs only every sata_bucket_size * sata_accept_period cycles (or every
+		cycle if less) and handles as many packets as it has earned. The bucket
+		always holds at least what is earned between calls to the handler so a
+		bucket smaller than 1/sata_accept_period doesn't reduce the bandwidth.
+		
+		sata_credit_latency is the number of cycles buffer credit takes to get back
+		to the sending end after a packet leaves the delay line (e.g. sata_latency
+		to model it being carried back down the link).
 		"""
 		
-		self.scheduler          = scheduler
-		self.num_channels       = num_channels
-		self.sata_accept_period = sata_accept_period
-		self.sata_buffer_length = sata_buffer_length
+		Link.__init__(self, scheduler)
+		
+		self.num_channels        = num_channels
+		self.sata_accept_period  = sata_accept_period
+		self.sata_buffer_length  = sata_buffer_length
+		self.sata_latency        = sata_latency
+		self.sata_bucket_size    = sata_bucket_size
+		self.sata_credit_latency = sata_credit_latency
+		
+		# The number of cycles between calls to the handler
+		if sata_bucket_size is None:
+			self.handler_period = sata_accept_period
+		else:
+			self.handler_period = max(1, int(sata_bucket_size * sata_accept_period))
+		
+		# The number of packets' worth of bandwidth the bucket can hold
+		if sata_bucket_size is None:
+			self.bucket_capacity = None
+		else:
+			self.bucket_capacity = max(sata_bucket_size,
+			                           self.handler_period / float(sata_accept_period))
+		
+		# The bandwidth earned (in packets) for input and output in the
+		# token-bucket model and the times they were last topped up
+		self.input_tokens  = self.bucket_capacity
+		self.output_tokens = self.bucket_capacity
+		self.input_time    = self.scheduler.clock
+		self.output_time   = self.scheduler.clock
 		
 		# The input and output from which the last packet was successfully
 		# sent/received
@@ -337,16 +505,160 @@ class SATALink(Link):
 			                                     , sata_latency
 			                                     ))
 			self.credit.append(self.sata_buffer_length)
+			
+			# Wake the handler when packets are sent into the link
+			self.in_links[-1].set_arrival_listener(self.wake)
+			self.delay_links[-1].set_arrival_listener(self.wake)
+		
+		# Credit on its way back to the sending end as (time_due, channel) pairs
+		self.credit_returns = deque()
+		
+		# Is the handler running? If not, the Timer (if any) which will wake it and
+		# the time it is due.
+		self.awake      = True
+		self.wake_timer = None
+		self.wake_time  = None
 		
 		# Schedule the input and output handler routine
-		self.scheduler.do_later(self.handler, self.sata_accept_period)
+		self.handler_task = self.scheduler.do_every(self.handler,
+		                                            self.handler_period,
+		                                            on_skip = self.skip_handler)
 	
 	
 	def handler(self):
 		"""
 		Handles up to one incoming packet and one outgoing per call.
 		"""
+		self.handle_output()
+		self.handle_input()
+		self.sleep_if_idle()
+	
+	
+	def input_handler(self):
+		"""
+		A handler for just the sending end of the link (e.g. when the receiving
+		end is simulated elsewhere).
+		"""
+		self.handle_input()
+		self.sleep_if_idle()
+	
+	
+	def output_handler(self):
+		"""
+		A handler for just the receiving end of the link (e.g. when the sending end
+		is simulated elsewhere).
+		"""
+		self.handle_output()
+		self.sleep_if_idle()
+	
+	
+	def set_handler(self, handler):
+		"""
+		Replace the handler (e.g. with input_handler or output_handler) keeping
+		the same schedule. Must be called between cycles.
+		"""
+		clock  = self.scheduler.clock
+		period = self.handler_period
+		
+		# The first time on the handler's schedule after the current cycle
+		task = self.handler_task
+		time = task.group.next_time if task.active else task.next_time
+		if time <= clock:
+			time += ((clock - time) // period + 1) * period
+		
+		self.stop_handler()
+		
+		self.awake = True
+		self.handler_task = self.scheduler.do_every(handler, period, time - clock,
+		                                            self.skip_handler)
+	
+	
+	def stop_handler(self):
+		"""
+		Stop calling the handler for good.
+		"""
+		self.handler_task.stop()
+		if self.wake_timer is not None:
+			self.wake_timer.cancel()
+		self.awake      = False
+		self.wake_timer = None
+		self.wake_time  = None
+	
+	
+	def sleep_if_idle(self):
+		"""
+		Put the handler to sleep if it has nothing to do until a packet in transit
+		(into the link or down a delay line) arrives, waking it when the first one
+		does.
+		"""
+		wake_time = None
+		
+		for in_link in self.in_links:
+			if in_link.last_state == SilistixLink.SENDING:
+				if in_link.transition_time <= self.scheduler.clock:
+					# A packet is waiting to be accepted
+					return
+				if wake_time is None or in_link.transition_time < wake_time:
+					wake_time = in_link.transition_time
+		
+		for delay_link in self.delay_links:
+			arrival_time = delay_link.next_arrival_time()
+			if arrival_time is not None:
+				if arrival_time <= self.scheduler.clock:
+					# A packet is waiting to be sent on
+					return
+				if wake_time is None or arrival_time < wake_time:
+					wake_time = arrival_time
+		
+		self.handler_task.pause()
+		self.awake = False
+		if wake_time is not None:
+			self.wake(wake_time)
+	
+	
+	def wake(self, time):
+		"""
+		Make sure the handler is running from the given time (at the latest).
+		"""
+		if self.awake or self.handler_task.stopped \
+		   or (self.wake_time is not None and self.wake_time <= time):
+			return
 		
+		if self.wake_timer is not None:
+			self.wake_timer.cancel()
+		self.wake_time  = time
+		self.wake_timer = self.scheduler.set_timer(self.wake_up,
+		                                           time - self.scheduler.clock)
+	
+	
+	def wake_up(self):
+		"""
+		Resume the handler (called by the Timer set by wake()).
+		"""
+		self.awake      = True
+		self.wake_timer = None
+		self.wake_time  = None
+		self.handler_task.resume()
+	
+	
+	def handle_output(self):
+		"""
+		Handles up to one outgoing packet (at the receiving end of the link) or,
+		in the token-bucket model, as many as the bandwidth earned allows.
+		"""
+		if self.sata_bucket_size is None:
+			self.output_packet()
+		else:
+			self.output_tokens = self.top_up(self.output_tokens, self.output_time)
+			self.output_time   = self.scheduler.clock
+			while self.output_tokens >= 1 and self.output_packet():
+				self.output_tokens -= 1
+	
+	
+	def output_packet(self):
+		"""
+		Send one packet out of the link. Returns True if there was one to send.
+		"""
 		# Try and handle an output starting with the output after the last handled
 		# output (round-robin style)
 		for channel_num in ((cn+self.last_output+1)%self.num_channels
@@ -358,12 +670,39 @@ class SATALink(Link):
 				# Take the packet out of the delay link and send it out to the world
 				self.out_links[channel_num].send(self.delay_links[channel_num].receive())
 				
-				# Increment the credit counter
-				self.credit[channel_num] += 1
+				# Send the credit back to the sending end
+				self.credit_returns.append((self.scheduler.clock + self.sata_credit_latency,
+				                            channel_num))
 				# Note which channel this was for next time
 				self.last_output = channel_num
-				break
+				return True
+		
+		return False
+	
+	
+	def handle_input(self):
+		"""
+		Handles up to one incoming packet (at the sending end of the link) or, in
+		the token-bucket model, as many as the bandwidth earned allows.
+		"""
+		# Increment the credit counters for any credit which has arrived back
+		while self.credit_returns \
+		      and self.credit_returns[0][0] <= self.scheduler.clock:
+			self.credit[self.credit_returns.popleft()[1]] += 1
 		
+		if self.sata_bucket_size is None:
+			self.input_packet()
+		else:
+			self.input_tokens = self.top_up(self.input_tokens, self.input_time)
+			self.input_time   = self.scheduler.clock
+			while self.input_tokens >= 1 and self.input_packet():
+				self.input_tokens -= 1
+	
+	
+	def input_packet(self):
+		"""
+		Send one packet into the link. Returns True if there was one to send.
+		"""
 		# Try and handle an input starting with the input after the last handled
 		# input (round-robin style)
 		for channel_num in ((cn+self.last_input+1)%self.num_channels
@@ -380,10 +719,25 @@ class SATALink(Link):
 				self.credit[channel_num] -= 1
 				# Note which channel this was for next time
 				self.last_input = channel_num
-				break
+				return True
 		
-		# Reschedule
-		self.scheduler.do_later(self.handler, self.sata_accept_period)
+		return False
+	
+	
+	def top_up(self, tokens, time):
+		"""
+		The number of tokens in a bucket holding the given number at the given time
+		after earning a token every sata_accept_period cycles since.
+		"""
+		return min(self.bucket_capacity,
+		           tokens + (self.scheduler.clock - time) / float(self.sata_accept_period))
+	
+	
+	def skip_handler(self, num_cycles):
+		"""
+		Nothing to do: the link is empty when no packets are in flight.
+		"""
+		pass
 	
 	
 	class SATALinkProxy(Link):
@@ -415,12 +769,68 @@ class SATALink(Link):
 		
 		def peek(self):
 			return self.sata_link.out_links[self.channel_num].peek()
+		
+		
+		def set_arrival_listener(self, listener):
+			self.sata_link.out_links[self.channel_num].set_arrival_listener(listener)
+		
+		
+		def set_space_listener(self, listener):
+			self.sata_link.in_links[self.channel_num].set_space_listener(listener)
+		
+		
+		def next_arrival_time(self):
+			return self.sata_link.out_links[self.channel_num].next_arrival_time()
+		
+		
+		def next_free_time(self):
+			return self.sata_link.in_links[self.channel_num].next_free_time()
+	
+	
+	class SATALinkChannel(Link):
+		"""
+		Link-style access to a single channel of the SATALink without the
+		indirection of a SATALinkProxy: the methods of the channel's input and
+		output SilistixLinks are bound to the object when it is created.
+		"""
+		
+		def __init__(self, sata_link, channel_num):
+			self.sata_link   = sata_link
+			self.channel_num = channel_num
+			
+			in_link  = sata_link.in_links[channel_num]
+			out_link = sata_link.out_links[channel_num]
+			
+			self.can_send    = in_link.can_send
+			self.send        = in_link.send
+			self.can_receive = out_link.can_receive
+			self.receive     = out_link.receive
+			self.peek        = out_link.peek
+			
+			self.set_arrival_listener = out_link.set_arrival_listener
+			self.set_space_listener   = in_link.set_space_listener
+			self.next_arrival_time    = out_link.next_arrival_time
+			self.next_free_time       = in_link.next_free_time
 	
 	
 	def get_channel_link(self, channel_num):
+		"""
+		Get a Link-style object which allows access to a single channel within the
+		link, calling the channel's SilistixLinks directly.
+		"""
+		assert(0 <= channel_num < self.num_channels)
+		return SATALink.SATALinkChannel(self, channel_num)
+	
+	
+	def get_channel_proxy(self, channel_num):
 		"""
 		Get a Link-style proxy object which allows transparent access to a single
-		channel within the link.
+		channel within the link (even if its SilistixLinks are replaced).
 		"""
 		assert(0 <= channel_num < self.num_channels)
 		return SATALink.SATALinkProxy(self, channel_num)
+
+
+# Make the channel classes visible at module level so that they can be pickled
+SATALinkProxy   = SATALink.SATALinkProxy
+SATALinkChannel = SATALink.SATALinkChannel
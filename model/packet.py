@@ -22,8 +22,11 @@ class SpiNNakerP2PPacket(object):
 		# The time-phase in which the packet was created
 		self.time_phase = self.system.time_phase
 		
-		# Add ourselves to the global set of packets
+		# Add ourselves to the global set of packets (our index in which serves as a
+		# unique ID)
+		self.id = len(self.system.packets)
 		self.system.packets.append(self)
+		self.system.packets_in_flight += 1
 		
 		# Optional meta-data for senders/receivers to fill in
 		self.send_time          = None # Time the packet was sent
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+"""
+A conservative parallel simulation engine which splits a SpiNNakerTorus (built
+with S-ATA links) between worker processes.
+
+Each worker process is forked from the fully built model and simulates only the
+boards it owns, the rest of its copy of the model lying idle. S-ATA links
+between boards owned by different workers are split: the sending end (input
+handler) is simulated by one worker and the receiving end (delay lines and
+output handler) by the other. Nothing sent down an S-ATA link has an effect at
+the other end within sata_latency cycles, nor returned credit within
+sata_credit_latency cycles (which must be non-zero for the split links), so the
+workers simulate windows of the lesser of these independently before exchanging
+what they sent down split links.
+
+The model is simulated exactly as by a single scheduler so long as each
+component behaves the same regardless of which process it runs in. In
+particular the traffic generators must have been given a seed: otherwise they
+draw from the random module, whose state each worker inherits, and the traffic
+generated in parallel differs from (though is statistically equivalent to) the
+sequential engine's.
+
+The workers are kept running between calls to run_until() and each time they
+reach the given cycle the counters of every router and traffic generator and
+the state of every packet are copied back into the original model which can
+then be inspected as if it had been simulated by its own scheduler. The rest of
+its state is left as it was so, once handed to the engine, it can only be
+simulated further by the engine. The model may have been simulated before but
+must not have any packets in flight when the engine starts.
+"""
+
+import os
+import sys
+import signal
+import traceback
+
+from cStringIO import StringIO
+
+import cPickle as pickle
+
+from multiprocessing import Queue
+
+from link import Link
+
+
+class RemoteLink(Link):
+	"""
+	Stands in for the delay line of an S-ATA link channel whose receiving end is
+	simulated by another process. Packets sent are collected with the time they
+	were sent so that they can be passed on.
+	"""
+	
+	def __init__(self, scheduler):
+		Link.__init__(self, scheduler)
+		
+		# A list of (send_time, packet) pairs sent since the list was last emptied
+		self.sent = []
+	
+	
+	def can_send(self):
+		return True
+	
+	
+	def send(self, data):
+		self.sent.append((self.scheduler.clock, data))
+	
+	
+	def can_receive(self):
+		return False
+	
+	
+	def next_arrival_time(self):
+		return None
+
+
+
+class WorkerFailed(Exception):
+	"""
+	Raised when a worker process (or one of its neighbours) fails.
+	"""
+	pass
+
+
+
+class ParallelEngine(object):
+	"""
+	Simulates a SpiNNakerTorus using num_workers worker processes, each owning a
+	contiguous group of its boards. The workers are started by the first call to
+	run_until() and must be stopped with close().
+	"""
+	
+	def __init__(self, scheduler, system, torus, num_workers):
+		assert(torus.sata_links)
+		assert(1 <= num_workers <= len(torus.boards))
+		
+		self.scheduler   = scheduler
+		self.system      = system
+		self.torus       = torus
+		self.num_workers = num_workers
+		
+		# The worker owning each board {coords: worker_num, ...}
+		self.owners = {}
+		board_coords = sorted(torus.boards)
+		for worker_num in range(num_workers):
+			for coords in board_coords[worker_num * len(board_coords) // num_workers
+			                          :(worker_num+1) * len(board_coords) // num_workers]:
+				self.owners[coords] = worker_num
+		
+		# The traffic generators in the order they're ticked each cycle (which is
+		# the order the packets they generate in a cycle are created).
+		self.generators = [ chip.traffic_generator
+		                    for board in torus.boards.itervalues()
+		                    for chip in board.chips.itervalues()
+		                  ]
+		self.generators.sort(key = (lambda generator: generator.tick_task.slot))
+		
+		# Objects referred to by packets which are not sent between processes but
+		# instead replaced by each process's own copy. {id(obj): index, ...}
+		self.shared = [system] + self.generators
+		self.shared_index = dict((id(obj), index)
+		                         for index, obj in enumerate(self.shared))
+		
+		# The number of cycles simulated between exchanges: nothing sent across a
+		# split link has an effect sooner.
+		self.window = min( min(link.sata_latency, link.sata_credit_latency)
+		                   for sender, receiver, link in torus.sata_links
+		                   if self.owners[sender] != self.owners[receiver]
+		                 ) if num_workers > 1 else None
+		assert(self.window is None or self.window >= 1)
+		
+		# The process IDs of the workers (None until they are started)
+		self.pids = None
+		
+		# The packets created since the engine started which have been received or
+		# dropped (and so won't change again), in the order they were created
+		self.finished = []
+	
+	
+	def dumps(self, obj):
+		"""
+		Pickle obj, leaving out any shared objects.
+		"""
+		f = StringIO()
+		pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+		pickler.inst_persistent_id = (lambda obj: self.shared_index.get(id(obj)))
+		pickler.dump(obj)
+		return f.getvalue()
+	
+	
+	def loads(self, string):
+		"""
+		Unpickle a string produced by dumps() (in any process), substituting this
+		process's copy of the shared objects.
+		"""
+		unpickler = pickle.Unpickler(StringIO(string))
+		unpickler.persistent_load = (lambda index: self.shared[int(index)])
+		return unpickler.load()
+	
+	
+	def start(self):
+		"""
+		Fork the worker processes.
+		"""
+		# Packets created before now are finished and so the same in every worker
+		assert(self.system.packets_in_flight == 0)
+		self.num_old_packets = len(self.system.packets)
+		
+		# An inbox for each worker, a queue of the cycles to simulate until for each
+		# worker and a queue for the results
+		self.inboxes  = [Queue() for _ in range(self.num_workers)]
+		self.commands = [Queue() for _ in range(self.num_workers)]
+		self.results  = Queue()
+		
+		# Don't let the workers inherit unwritten output
+		sys.stdout.flush()
+		
+		self.pids = []
+		for worker_num in range(self.num_workers):
+			pid = os.fork()
+			if pid == 0:
+				# Worker: never return to the caller
+				status = 1
+				try:
+					try:
+						self.work(worker_num)
+						status = 0
+					except:
+						traceback.print_exc()
+						self.results.put(None)
+					sys.stdout.flush()
+					for queue in self.inboxes + self.commands + [self.results]:
+						queue.close()
+						queue.join_thread()
+				finally:
+					os._exit(status)
+			self.pids.append(pid)
+		
+		# The routers are no longer simulated here: their counters are copied from
+		# the workers, having already accounted for any routing steps skipped.
+		self.system.sleeping_routers.clear()
+		for board in self.torus.boards.itervalues():
+			for chip in board.chips.itervalues():
+				chip.router.sleep_time      = None
+				chip.router.blocked_packets = []
+	
+	
+	def run_until(self, cycle):
+		"""
+		Simulate the torus in parallel until the given cycle (see
+		Scheduler.run_until()) and then copy the results back into the model.
+		Returns the clock value reached.
+		"""
+		if self.pids is None:
+			self.start()
+		
+		for commands in self.commands:
+			commands.put(cycle)
+		
+		results = [self.results.get() for _ in range(self.num_workers)]
+		if None in results:
+			self.close()
+			raise WorkerFailed()
+		
+		self.merge(map(self.loads, results))
+		
+		return self.scheduler.clock
+	
+	
+	def close(self):
+		"""
+		Stop the worker processes (if started).
+		"""
+		if self.pids is None:
+			return
+		
+		for commands in self.commands:
+			commands.put(None)
+		for pid in self.pids:
+			os.waitpid(pid, 0)
+		self.pids = None
+	
+	
+	def work(self, worker_num):
+		"""
+		Simulate the boards owned by the given worker (in a worker process) until
+		each cycle it is sent, putting the results to be merged back into the model
+		in the results queue, until it is sent None.
+		"""
+		scheduler = self.scheduler
+		system    = self.system
+		
+		# Stopping is up to the parent process
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGTERM, signal.SIG_IGN)
+		
+		# Stop everything on the boards owned by other workers
+		for coords, board in self.torus.boards.iteritems():
+			if self.owners[coords] != worker_num:
+				for chip in board.chips.itervalues():
+					chip.router.route_task.stop()
+					if chip.router.wake_timer is not None:
+						chip.router.wake_timer.cancel()
+					chip.traffic_generator.tick_task.stop()
+					if chip.traffic_generator.injection_timer is not None:
+						chip.traffic_generator.injection_timer.cancel()
+		
+		# Split the S-ATA links to/from other workers' boards into lists of
+		# (link_num, link, other_worker_num).
+		outgoing = []
+		incoming = []
+		for link_num, (sender, receiver, link) in enumerate(self.torus.sata_links):
+			sender_num   = self.owners[sender]
+			receiver_num = self.owners[receiver]
+			if sender_num == worker_num and receiver_num == worker_num:
+				continue
+			
+			if sender_num == worker_num:
+				# Send packets to the other worker rather than down the delay lines
+				link.delay_links = [RemoteLink(scheduler)
+				                    for _ in range(link.num_channels)]
+				link.set_handler(link.input_handler)
+				outgoing.append((link_num, link, receiver_num))
+			elif receiver_num == worker_num:
+				link.set_handler(link.output_handler)
+				incoming.append((link_num, link, sender_num))
+			else:
+				link.stop_handler()
+		
+		neighbours = set(other_num for _, _, other_num in outgoing + incoming)
+		
+		# The packets this worker has which are yet to be sent back: those in flight
+		# when the results were last sent or which have since arrived from other
+		# workers, and those created since (from this index in system.packets), less
+		# those which have since departed for other workers.
+		in_flight       = set()
+		num_old_packets = self.num_old_packets
+		departed        = set()
+		
+		# Messages received early from neighbours {worker_num: [message, ...], ...}
+		early = dict((other_num, []) for other_num in neighbours)
+		
+		try:
+			while True:
+				cycle = self.commands[worker_num].get()
+				if cycle is None:
+					return
+				
+				# Simulate in windows, exchanging what was sent down split links after
+				# each (including the last so that the next call can carry on)
+				while scheduler.clock + 1 < cycle:
+					if self.window is None:
+						end = cycle
+					else:
+						end = min(scheduler.clock + 1 + self.window, cycle)
+					scheduler.run_until(end)
+					
+					# Nothing else is due before the end of the window
+					scheduler.clock = end - 1
+					
+					if neighbours:
+						self.exchange(worker_num, outgoing, incoming, neighbours,
+						              early, in_flight, departed)
+				
+				# The counters of the components owned (accounting for the routing steps
+				# skipped by sleeping routers)
+				counters = {}
+				for coords, board in self.torus.boards.iteritems():
+					if self.owners[coords] == worker_num:
+						for chip in board.chips.itervalues():
+							chip.router.catch_up(cycle)
+						counters[coords] = dict(
+							(chip_coords, ( chip.router.counters
+							              , chip.traffic_generator.counters))
+							for chip_coords, chip in board.chips.iteritems())
+				
+				# The packets created or arrived since the last results, and those still
+				# in flight, are sent back (those since received or dropped for the last
+				# time)
+				in_flight.update(system.packets[num_old_packets:])
+				num_old_packets = len(system.packets)
+				in_flight -= departed
+				departed.clear()
+				packets = list(in_flight)
+				in_flight = set( packet for packet in packets
+				                 if packet.receive_time is None
+				                 and packet.drop_time is None)
+				
+				# Any profile recorded is sent back (and restarted)
+				profile = None
+				if scheduler.profiler is not None:
+					profile = (dict(scheduler.profiler.calls),
+					           dict(scheduler.profiler.time))
+					scheduler.profiler.calls.clear()
+					scheduler.profiler.time.clear()
+				
+				self.results.put(self.dumps({ "clock"      : scheduler.clock
+				                            , "time_phase" : system.time_phase
+				                            , "counters"   : counters
+				                            , "packets"    : packets
+				                            , "profile"    : profile
+				                            }))
+		except:
+			# Don't leave the neighbours waiting
+			for other_num in neighbours:
+				self.inboxes[other_num].put((worker_num, None))
+			raise
+	
+	
+	def exchange(self, worker_num, outgoing, incoming, neighbours, early,
+	             in_flight, departed):
+		"""
+		Send the packets and credit sent down split links during the window just
+		simulated to the neighbouring workers and deliver those they sent (in a
+		worker process, see work()).
+		"""
+		system = self.system
+		
+		# Collect the packets and credit sent down split links as
+		# {worker_num: ([(link_num, channel, send_time, packet), ...],
+		#               [(link_num, time_due, channel), ...]), ...}
+		messages = dict((other_num, ([], [])) for other_num in neighbours)
+		for link_num, link, other_num in outgoing:
+			for channel, remote_link in enumerate(link.delay_links):
+				for send_time, packet in remote_link.sent:
+					messages[other_num][0].append((link_num, channel, send_time, packet))
+					departed.add(packet)
+					system.packets_in_flight -= 1
+				remote_link.sent = []
+		for link_num, link, other_num in incoming:
+			for time_due, channel in link.credit_returns:
+				messages[other_num][1].append((link_num, time_due, channel))
+			link.credit_returns.clear()
+		
+		for other_num, message in messages.iteritems():
+			self.inboxes[other_num].put((worker_num, self.dumps(message)))
+		
+		# Wait for a message from every neighbour, keeping any sent for the next
+		# window (from neighbours which have already finished this one)
+		received = {}
+		while len(received) < len(neighbours):
+			for other_num in neighbours:
+				if other_num not in received and early[other_num]:
+					received[other_num] = early[other_num].pop(0)
+			if len(received) == len(neighbours):
+				break
+			
+			other_num, message = self.inboxes[worker_num].get()
+			if message is None:
+				raise WorkerFailed()
+			early[other_num].append(message)
+		
+		for other_num in sorted(received):
+			packets, credits = self.loads(received[other_num])
+			for link_num, channel, send_time, packet in packets:
+				link = self.torus.sata_links[link_num][2]
+				link.delay_links[channel].deliver(packet, send_time)
+				in_flight.add(packet)
+				system.packets_in_flight += 1
+			for link_num, time_due, channel in credits:
+				link = self.torus.sata_links[link_num][2]
+				link.credit_returns.append((time_due, channel))
+	
+	
+	def merge(self, results):
+		"""
+		Copy the results sent back by each worker's work() into the model.
+		"""
+		packets = []
+		for result in results:
+			self.scheduler.clock = max(self.scheduler.clock, result["clock"])
+			self.system.time_phase = result["time_phase"]
+			
+			for coords, chip_counters in result["counters"].iteritems():
+				board = self.torus.boards[coords]
+				for chip_coords, (router_counters, generator_counters) \
+				    in chip_counters.iteritems():
+					board.chips[chip_coords].router.stat_counters.update(router_counters)
+					board.chips[chip_coords].traffic_generator.counters.update(generator_counters)
+			
+			packets.extend(result["packets"])
+			
+			if result["profile"] is not None and self.scheduler.profiler is not None:
+				calls, time = result["profile"]
+				for name in calls:
+					self.scheduler.profiler.calls[name] += calls[name]
+					self.scheduler.profiler.time[name]  += time[name]
+		
+		# Order the new packets as they would have been created by a single
+		# scheduler
+		key = (lambda packet: (packet.send_time, self.shared_index[id(packet.data)]))
+		in_flight = []
+		for packet in packets:
+			if packet.receive_time is None and packet.drop_time is None:
+				in_flight.append(packet)
+			else:
+				self.finished.append(packet)
+		self.finished.sort(key = key)
+		
+		packets = self.system.packets[:self.num_old_packets] \
+		          + sorted(self.finished + in_flight, key = key)
+		for num, packet in enumerate(packets):
+			packet.id = num
+		self.system.packets = packets
+		self.system.packets_in_flight = len(in_flight)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+A profiler for the scheduler which attributes the number of calls to, and the
+wall-clock time spent in, each kind of task.
+"""
+
+from collections import defaultdict
+
+from timeit import default_timer
+
+from scheduler import Timer
+from scheduler import Batch
+
+
+def task_name(task):
+	"""
+	Get a name for the kind of task given: "Class.method" for bound methods
+	(including those wrapped in a Timer and those called by a Batch), the name of
+	plain functions or the class of any other callable.
+	"""
+	if type(task) is Timer:
+		task = task.c
+	elif type(task) is Batch:
+		cls, method_name = task.method
+		return "%s.%s"%(cls.__name__, method_name)
+	
+	if hasattr(task, "im_self") and task.im_self is not None:
+		return "%s.%s"%(type(task.im_self).__name__, task.__name__)
+	elif hasattr(task, "__name__"):
+		return task.__name__
+	else:
+		return type(task).__name__
+
+
+class Profiler(object):
+	"""
+	Records the number of calls and total time spent in each kind of task (see
+	task_name()) executed by a Scheduler. Set a Scheduler's profiler attribute to
+	an instance to use.
+	"""
+	
+	def __init__(self):
+		# {name: number_of_calls, ...}
+		self.calls = defaultdict(int)
+		
+		# {name: total_seconds, ...}
+		self.time = defaultdict(float)
+	
+	
+	def execute(self, tasks):
+		"""
+		Call each of the given tasks in order, recording the time taken. A Batch
+		counts as one call for each object it calls the method on.
+		"""
+		for task in tasks:
+			if type(task) is Timer and task.due != task.scheduler.clock:
+				# A cancelled Timer's tombstone: not a call of its task
+				task()
+				continue
+			name = task_name(task)
+			start = default_timer()
+			task()
+			self.time[name] += default_timer() - start
+			self.calls[name] += len(task.objects) if type(task) is Batch else 1
+	
+	
+	def write_report(self, f):
+		"""
+		Write a report to the file f listing each kind of task in descending order
+		of total time taken.
+		"""
+		f.write("#task calls total_time time_per_call\n")
+		for name in sorted(self.time, key=(lambda name: -self.time[name])):
+			f.write("%s %d %f %e\n"%(name, self.calls[name], self.time[name],
+			                         self.time[name] / self.calls[name]))
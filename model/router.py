@@ -68,8 +68,8 @@ class SpiNNakerRouter(object):
 		self.mesh_position   = (0,0)
 		
 		
-		# Stat counters
-		self.counters = {
+		# Stat counters (read through the counters property)
+		self.stat_counters = {
 			# A packet whose timestamp was too old was dropped
 			"timestamp_packet_timeout" : 0,
 			
@@ -96,8 +96,21 @@ class SpiNNakerRouter(object):
 		# cycled to achieve a round-robin priority system
 		self.first_link = 0
 		
-		# Schedule the routing step
-		self.scheduler.do_later(self.do_route, self.period)
+		# Is the router routing every step? A router whose packets are all blocked
+		# goes to sleep (see sleep_if_blocked()). While asleep, the time of the last
+		# routing step accounted for and the packets blocked at the time.
+		self.awake           = True
+		self.sleep_time      = None
+		self.blocked_packets = []
+		
+		# The Timer which will wake the router and the time it is due (if any)
+		self.wake_timer = None
+		self.wake_time  = None
+		
+		# Schedule the routing step (routed in batches with the other routers)
+		self.scheduler.set_batch_handler(SpiNNakerRouter.do_route, route_batch)
+		self.route_task = self.scheduler.do_every(self.do_route, self.period,
+		                                          on_skip = self.skip_route)
 	
 	
 	def set_mesh_dimensions(self, w, h):
@@ -155,7 +168,8 @@ class SpiNNakerRouter(object):
 					packet.wait      = 0
 					packet.emergency = False
 					dst_link.send(src_link.receive())
-					self.counters["packets_routed"] += 1
+					self.stat_counters["packets_routed"] += 1
+					self.scheduler.trace_event(self, "routed", packet)
 					
 					blocked = False
 					
@@ -170,19 +184,158 @@ class SpiNNakerRouter(object):
 					packet.emergency_location.append(self.mesh_position)
 					# Send the packet via emergency route
 					emg_link.send(src_link.receive())
-					self.counters["packet_emergency_routed"] += 1
+					self.stat_counters["packet_emergency_routed"] += 1
+					self.scheduler.trace_event(self, "emergency_routed", packet)
 					
 					blocked = False
 		
 		# General counters
-		self.counters["router_cycles"] += 1
+		self.stat_counters["router_cycles"] += 1
 		if idle:
-			self.counters["router_idle_cycles"] += 1
+			self.stat_counters["router_idle_cycles"] += 1
 		if not idle and blocked:
-			self.counters["router_blocked_cycles"] += 1
+			self.stat_counters["router_blocked_cycles"] += 1
+			self.sleep_if_blocked()
+	
+	
+	@property
+	def counters(self):
+		"""
+		The router's stat counters, accounting for any routing steps skipped while
+		asleep (see catch_up()) before the current cycle.
+		"""
+		self.catch_up(self.scheduler.clock)
+		return self.stat_counters
+	
+	
+	def skip_route(self, num_cycles):
+		"""
+		Account for num_cycles routing steps skipped while no packets were in flight
+		in the system (and so the router was idle).
+		"""
+		self.stat_counters["router_cycles"]      += num_cycles
+		self.stat_counters["router_idle_cycles"] += num_cycles
 		
-		# Schedule the next routing step
-		self.scheduler.do_later(self.do_route, self.period)
+		# The round-robin counter is still advanced every cycle
+		self.first_link = (self.first_link + num_cycles) % (len(self.in_links) + 1)
+	
+	
+	def sleep_if_blocked(self):
+		"""
+		Put the router to sleep after a routing step in which none of its packets
+		could be routed. It is woken when one of the outputs they're waiting for
+		becomes free, a packet arrives, a packet becomes due to be emergency routed
+		or dropped or the time phase changes (possibly expiring packets). The
+		routing steps skipped in the meantime are accounted for by catch_up().
+		
+		The waits before emergency routing and dropping must not be reduced while
+		the router is asleep.
+		"""
+		clock = self.scheduler.clock
+		
+		# Times the router may be able to do something (None if unknown)
+		wake_times = [self.system.time_phase_task.get_next_time()]
+		
+		empty_links   = []
+		blocked_links = []
+		self.blocked_packets = []
+		for link in self.in_links + [self.injection_link]:
+			if not link.can_receive():
+				empty_links.append(link)
+				wake_times.append(link.next_arrival_time())
+				continue
+			
+			packet = link.peek()
+			self.blocked_packets.append(packet)
+			
+			in_dir = self.in_links.index(link) if link in self.in_links else None
+			dst_link, emg_link = self.get_packet_destination(packet, in_dir)
+			
+			# The packet is dropped after this many more routing steps
+			num_steps = self.wait_before_drop - packet.wait + 2
+			
+			blocked_links.append(dst_link)
+			if emg_link != dst_link:
+				blocked_links.append(emg_link)
+				if packet.wait <= self.wait_before_emergency:
+					# ...or may be emergency routed after this many
+					num_steps = min(num_steps,
+					                self.wait_before_emergency - packet.wait + 1)
+			
+			wake_times.append(clock + num_steps * self.period)
+		
+		for link in blocked_links:
+			wake_times.append(link.next_free_time())
+		
+		self.route_task.pause()
+		self.awake      = False
+		self.sleep_time = clock
+		self.system.sleeping_routers.add(self)
+		
+		for link in empty_links:
+			link.set_arrival_listener(self.wake)
+		for link in blocked_links:
+			link.set_space_listener(self.wake)
+		
+		# (An emergency output which is already free is waited on until a packet
+		# may be emergency routed.)
+		wake_times = [time for time in wake_times
+		              if time is not None and time > clock]
+		if wake_times:
+			self.wake(min(wake_times))
+	
+	
+	def wake(self, time):
+		"""
+		Make sure the router is routing from the given time (at the latest).
+		"""
+		if self.awake or self.route_task.stopped \
+		   or (self.wake_time is not None and self.wake_time <= time):
+			return
+		
+		if self.wake_timer is not None:
+			self.wake_timer.cancel()
+		self.wake_time  = time
+		self.wake_timer = self.scheduler.set_timer(self.wake_up,
+		                                           time - self.scheduler.clock)
+	
+	
+	def wake_up(self):
+		"""
+		Resume routing (called by the Timer set by wake()).
+		"""
+		self.awake      = True
+		self.wake_timer = None
+		self.wake_time  = None
+		
+		self.catch_up(self.scheduler.clock)
+		self.sleep_time      = None
+		self.blocked_packets = []
+		self.system.sleeping_routers.discard(self)
+		
+		self.route_task.resume()
+	
+	
+	def catch_up(self, time):
+		"""
+		Account for the routing steps skipped while asleep which were due before the
+		given time: each would have found the blocked packets still blocked. The
+		counters property and SpiNNakerSystem.catch_up() call this.
+		"""
+		if self.sleep_time is None:
+			return
+		
+		num_steps = (time - self.sleep_time - 1) // self.period
+		if num_steps <= 0:
+			return
+		self.sleep_time += num_steps * self.period
+		
+		for packet in self.blocked_packets:
+			packet.wait += num_steps
+		
+		self.stat_counters["router_cycles"]         += num_steps
+		self.stat_counters["router_blocked_cycles"] += num_steps
+		self.first_link = (self.first_link + num_steps) % (len(self.in_links) + 1)
 	
 	
 	def discard_expired_packets(self):
@@ -194,10 +347,12 @@ class SpiNNakerRouter(object):
 			while link.can_receive():
 				if link.peek().has_expired():
 					# The timestamp is too old
-					self.counters["timestamp_packet_timeout"] += 1
+					self.stat_counters["timestamp_packet_timeout"] += 1
+					self.scheduler.trace_event(self, "timestamp_timeout", link.peek())
 				elif link.peek().wait > self.wait_before_drop:
 					# The packet has been in the router too long
-					self.counters["router_packet_timeout"] += 1
+					self.stat_counters["router_packet_timeout"] += 1
+					self.scheduler.trace_event(self, "router_timeout", link.peek())
 				else:
 					# The packet shouldn't be expired
 					break
@@ -206,6 +361,7 @@ class SpiNNakerRouter(object):
 				packet = link.receive()
 				packet.drop_time = self.scheduler.clock
 				packet.drop_location = self.mesh_position
+				self.system.packets_in_flight -= 1
 	
 	
 	def links_in_service_order(self):
@@ -257,3 +413,21 @@ class SpiNNakerRouter(object):
 			# The emergency route takes the link counter-clockwise to the intended
 			# direction
 			return (self.out_links[direction], self.out_links[topology.next_ccw(direction)])
+
+
+def route_batch(routers):
+	"""
+	Batch handler for SpiNNakerRouter.do_route (see Scheduler.set_batch_handler()).
+	Routers with no incoming packets only need their counters updating.
+	"""
+	for router in routers:
+		if router.injection_link.can_receive():
+			router.do_route()
+			continue
+		
+		for link in router.in_links:
+			if link.can_receive():
+				router.do_route()
+				break
+		else:
+			router.skip_route(1)
@@ -4,7 +4,421 @@
 A Verilog-style discrete-time scheduler.
 """
 
-from collections import defaultdict
+from array import array
+
+from collections import deque
+
+from heapq import heappush
+from heapq import heappop
+
+from bisect import bisect_left
+
+
+class Timer(object):
+	"""
+	A handle on a task scheduled with Scheduler.set_timer() which can be used to
+	cancel or reschedule it. Cancelled tasks are not removed from the scheduler's
+	queues, they simply do nothing when their time comes (and aren't counted as
+	executed).
+	"""
+	
+	__slots__ = ["scheduler", "c", "due"]
+	
+	def __init__(self, scheduler, c):
+		self.scheduler = scheduler
+		self.c         = c
+		
+		# The time the task is due to be called or None if it has been called or
+		# cancelled
+		self.due = None
+	
+	
+	def __call__(self):
+		if self.due == self.scheduler.clock:
+			self.due = None
+			self.c()
+		else:
+			# A tombstone left by cancel() or reschedule()
+			self.scheduler.num_executed -= 1
+	
+	
+	def cancel(self):
+		"""
+		Don't call the task.
+		"""
+		self.due = None
+	
+	
+	def reschedule(self, delay = 0):
+		"""
+		Call the task after delay cycles instead of when it was due (or again, if it
+		has already been called).
+		"""
+		self.scheduler.schedule(self, delay)
+	
+	
+	def is_pending(self):
+		"""
+		Is the task still waiting to be called?
+		"""
+		return self.due is not None
+
+
+class PeriodicTask(object):
+	"""
+	A handle on a task registered with Scheduler.do_every() which can be used to
+	pause, resume or stop the task.
+	"""
+	
+	def __init__(self, scheduler, group, c, on_skip = None):
+		self.scheduler = scheduler
+		self.group     = group
+		self.c         = c
+		self.on_skip   = on_skip
+		
+		# The task's slot in its group
+		self.slot = group.add(self)
+		
+		# Is the task currently being dispatched by its group?
+		self.active = False
+		
+		# Has the task been stopped for good?
+		self.stopped = False
+		
+		# Is the task waiting to join its group at a later time?
+		self.pending = False
+		
+		# The next time the task is due to be called (only valid while paused, when
+		# active the group's next_time is used)
+		self.next_time = None
+	
+	
+	def pause(self):
+		"""
+		Stop calling the task until resume() is called. If the task has already
+		been dispatched in the current cycle it will still be called.
+		"""
+		self.pending = False
+		if self.active:
+			self.next_time = self.group.next_time
+			self.group.deactivate(self)
+			self.active = False
+	
+	
+	def resume(self):
+		"""
+		Resume calling the task at its original period and phase. If the task was
+		due in the current cycle while paused it is called in this cycle.
+		"""
+		assert(not self.stopped)
+		if self.active or self.pending:
+			return
+		
+		clock  = self.scheduler.clock
+		period = self.group.period
+		
+		# Find the first time on the task's schedule which hasn't been missed
+		time = self.next_time
+		if time < clock:
+			time += ((clock - time + period - 1) // period) * period
+		
+		# Groups have already been dispatched for the current cycle
+		if time == clock:
+			self.scheduler.do_now(self.c)
+			time += period
+		
+		if self.group.num_active and time != self.group.next_time:
+			# Not due until after the group's next dispatch: join the group when due.
+			self.next_time = time
+			self.pending   = True
+			self.scheduler.do_later(self._join, time - clock)
+		else:
+			self.group.activate(self, time)
+			self.active = True
+	
+	
+	def _join(self):
+		"""
+		Resume a task whose resumption was deferred until it was next due.
+		"""
+		if self.pending:
+			self.pending = False
+			self.resume()
+	
+	
+	def get_next_time(self):
+		"""
+		Get the next time the task is due to be called (or would be, if paused) or
+		None if it has been stopped.
+		"""
+		if self.stopped:
+			return None
+		elif self.active:
+			return self.group.next_time
+		else:
+			return self.next_time
+	
+	
+	def stop(self):
+		"""
+		Stop calling the task for good.
+		"""
+		self.pause()
+		self.stopped = True
+		self.group.remove(self)
+
+
+class Batch(object):
+	"""
+	A task which calls a batch handler (see Scheduler.set_batch_handler()) with a
+	list of objects in place of calling the method (a (class, method_name) pair)
+	on each.
+	"""
+	
+	__slots__ = ["handler", "objects", "method", "slots"]
+	
+	def __init__(self, handler, objects, method, slots):
+		self.handler = handler
+		self.objects = objects
+		self.method  = method
+		
+		# The group slots of the objects' tasks (in ascending order)
+		self.slots = slots
+	
+	
+	def __call__(self):
+		self.handler(self.objects)
+
+
+
+class PeriodicGroup(object):
+	"""
+	A group of periodic tasks which share a period and phase and so are all
+	dispatched to the ready queue in one go each time they fall due.
+	
+	Tasks which are bound methods with a batch handler in batch_handlers (a dict
+	{(class, method_name): handler, ...}) are dispatched as a single Batch in
+	place of the first of them.
+	
+	The list of callables dispatched is updated, when next dispatched, only where
+	tasks have been activated or deactivated rather than rebuilt.
+	"""
+	
+	def __init__(self, period, phase, batch_handlers):
+		self.period = period
+		self.phase  = phase
+		
+		self.batch_handlers = batch_handlers
+		
+		# The next time the group's active tasks are due (only valid while the group
+		# has active tasks)
+		self.next_time = None
+		
+		# The number of active tasks which can't be skipped (have no on_skip)
+		self.num_unskippable = 0
+		
+		# The callables of the tasks in the group in the order they were added (None
+		# if the task is paused or stopped) and the corresponding PeriodicTasks.
+		self.slots   = []
+		self.members = []
+		
+		self.num_active = 0
+		
+		# The list of the active callables (and Batches) in slot order, None when
+		# it must be rebuilt, and the slot of each (that of the first task for a
+		# Batch).
+		self.dispatch_list  = None
+		self.dispatch_slots = None
+		
+		# The callable of each slot as it appears in the dispatch list (None if
+		# absent) and the slots changed since the dispatch list was last updated.
+		self.listed  = []
+		self.changed = []
+		
+		# The Batches in the dispatch list {(class, method_name): Batch, ...}
+		self.batches = {}
+	
+	
+	def add(self, task):
+		"""
+		Add an (inactive) task to the group, returning its slot.
+		"""
+		self.slots.append(None)
+		self.members.append(task)
+		self.listed.append(None)
+		return len(self.slots) - 1
+	
+	
+	def remove(self, task):
+		"""
+		Remove an (inactive) task from the group for good.
+		"""
+		self.members[task.slot] = None
+	
+	
+	def activate(self, task, time):
+		"""
+		Start dispatching a task, next due at the given time.
+		"""
+		if self.num_active == 0:
+			self.next_time = time
+		self.num_active += 1
+		if task.on_skip is None:
+			self.num_unskippable += 1
+		self.slots[task.slot] = task.c
+		self.changed.append(task.slot)
+	
+	
+	def deactivate(self, task):
+		"""
+		Stop dispatching a task.
+		"""
+		self.num_active -= 1
+		if task.on_skip is None:
+			self.num_unskippable -= 1
+		self.slots[task.slot] = None
+		if self.num_active:
+			self.changed.append(task.slot)
+		else:
+			# Not dispatched again until a task is activated: rebuild the list then
+			self.dispatch_list = None
+			self.changed       = []
+	
+	
+	def batch_key(self, c):
+		"""
+		Get the (object, (class, method_name)) of a callable which is dispatched in
+		a Batch or (None, None) if it is called directly.
+		"""
+		obj = getattr(c, "im_self", None)
+		if obj is not None:
+			key = (type(obj), c.__name__)
+			if key in self.batch_handlers:
+				return (obj, key)
+		return (None, None)
+	
+	
+	def insert(self, slot, c):
+		"""
+		Add the callable of the task in the given slot to the dispatch list.
+		"""
+		self.listed[slot] = c
+		
+		obj, key = self.batch_key(c)
+		if key is None:
+			entry = c
+		elif key not in self.batches:
+			entry = self.batches[key] = Batch(self.batch_handlers[key], [obj], key,
+			                                  [slot])
+		else:
+			batch = self.batches[key]
+			old_first = batch.slots[0]
+			index = bisect_left(batch.slots, slot)
+			batch.slots.insert(index, slot)
+			batch.objects.insert(index, obj)
+			if index != 0:
+				return
+			
+			# The Batch moves to its new first task's place
+			index = bisect_left(self.dispatch_slots, old_first)
+			del self.dispatch_slots[index]
+			del self.dispatch_list[index]
+			entry = batch
+		
+		index = bisect_left(self.dispatch_slots, slot)
+		self.dispatch_slots.insert(index, slot)
+		self.dispatch_list.insert(index, entry)
+	
+	
+	def delete(self, slot):
+		"""
+		Remove the callable of the task in the given slot from the dispatch list.
+		"""
+		obj, key = self.batch_key(self.listed[slot])
+		self.listed[slot] = None
+		
+		if key is None:
+			index = bisect_left(self.dispatch_slots, slot)
+			del self.dispatch_slots[index]
+			del self.dispatch_list[index]
+			return
+		
+		batch = self.batches[key]
+		old_first = batch.slots[0]
+		index = bisect_left(batch.slots, slot)
+		del batch.slots[index]
+		del batch.objects[index]
+		if index != 0:
+			return
+		
+		index = bisect_left(self.dispatch_slots, old_first)
+		del self.dispatch_slots[index]
+		del self.dispatch_list[index]
+		if batch.slots:
+			# The Batch moves to its new first task's place
+			index = bisect_left(self.dispatch_slots, batch.slots[0])
+			self.dispatch_slots.insert(index, batch.slots[0])
+			self.dispatch_list.insert(index, batch)
+		else:
+			del self.batches[key]
+	
+	
+	def update(self):
+		"""
+		Bring the dispatch list up to date with the tasks activated and deactivated
+		since it was last dispatched, rebuilding it if most tasks have changed.
+		"""
+		if self.dispatch_list is None or 2 * len(self.changed) > len(self.slots):
+			self.dispatch_list  = []
+			self.dispatch_slots = []
+			self.listed         = [None] * len(self.slots)
+			self.batches        = {}
+			changed = xrange(len(self.slots))
+		else:
+			changed = sorted(set(self.changed))
+		self.changed = []
+		
+		for slot in changed:
+			c = self.slots[slot]
+			if c is not self.listed[slot]:
+				if self.listed[slot] is not None:
+					self.delete(slot)
+				if c is not None:
+					self.insert(slot, c)
+	
+	
+	def dispatch(self):
+		"""
+		Get the list of callables to call at next_time and advance next_time.
+		
+		The list and the Batches in it are only changed by the next call, by which
+		time the tasks dispatched have been called.
+		"""
+		if self.changed or self.dispatch_list is None:
+			self.update()
+		
+		self.next_time += self.period
+		return self.dispatch_list
+	
+	
+	def skip(self, time):
+		"""
+		Skip calling the group's tasks at every time they're due before the given
+		time, calling their on_skip with the number of calls skipped. Returns the
+		time of the last call skipped or None if none were.
+		"""
+		if self.next_time >= time:
+			return None
+		
+		num_skipped = (time - self.next_time + self.period - 1) // self.period
+		self.next_time += num_skipped * self.period
+		
+		for task in self.members:
+			if task is not None and task.active:
+				task.on_skip(num_skipped)
+		
+		return self.next_time - self.period
+
 
 class Scheduler(object):
 	"""
@@ -12,14 +426,78 @@ class Scheduler(object):
 	 * Ready: tasks which are ready to be run and may be executed in any order.
 	 * Inactive: tasks which can run once all ready tasks have been executed.
 	 * Postponed: Tasks which should run at some point in the future
+	
+	All queues are FIFO deques so that dispatching a task is O(1) no matter how
+	many tasks are due in the same cycle.
+	
+	Periodic tasks (see do_every()) are kept in groups sharing a period and phase
+	which are appended to the ready queue, after any postponed tasks, in the
+	cycles they are due.
+	
+	Periodic tasks of the same kind (e.g. the routing step of every router) may
+	be executed in a single call to a batch handler (see set_batch_handler()).
+	
+	If an idle_test is given and returns True when the clock is about to advance,
+	the scheduler skips over any cycles in which only periodic tasks with an
+	on_skip are due (see do_every()).
 	"""
 	
 	def __init__(self):
 		self.clock = 0
 		
-		self.ready     = []
-		self.inactive  = []
-		self.postponed = defaultdict(list)
+		self.ready     = deque()
+		self.inactive  = deque()
+		
+		# A dictionary {time: deque([task, ...]), ...} of postponed tasks and a
+		# heap of the times present in the dictionary which allows the next time to
+		# be found without scanning every key.
+		self.postponed       = {}
+		self.postponed_times = []
+		
+		# A list of PeriodicGroups
+		self.periodic_groups = []
+		
+		# Batch handlers for periodic tasks {(class, method_name): handler, ...}
+		self.batch_handlers = {}
+		
+		# An optional callable which returns True when all periodic tasks with an
+		# on_skip are known to have nothing to do. Set to allow idle cycles to be
+		# fast-forwarded over.
+		self.idle_test = None
+		
+		# The periodic groups whose tasks due in the current cycle are being skipped
+		# (see _skip_idle()) once the clock edge hook has been called
+		self.skipping_groups = []
+		
+		# An optional Profiler which, if set, is used to execute (and time) the tasks
+		# run by run_until().
+		self.profiler = None
+		
+		# An optional Trace which, if set, records the events passed to
+		# trace_event().
+		self.trace = None
+		
+		# The total number of tasks executed so far (each task called by a Batch
+		# counts as one)
+		self.num_executed = 0
+		
+		# Per-cycle load statistics (see record_load()): the time of each cycle in
+		# which tasks were run, the number of tasks due at its start and the value
+		# of num_executed at its start. None unless recording.
+		self.load_clocks   = None
+		self.load_due      = None
+		self.load_executed = None
+		
+		# Set by stop() to make run_until() return at the end of the current cycle
+		self.stopping = False
+	
+	
+	def stop(self):
+		"""
+		Make run_until() return at the end of the current cycle rather than
+		advancing the clock. Safe to call from a signal handler or a task.
+		"""
+		self.stopping = True
 	
 	
 	def do_now(self, c):
@@ -41,7 +519,252 @@ class Scheduler(object):
 		if delay == 0:
 			self.inactive.append(c)
 		else:
-			self.postponed[self.clock + delay].append(c)
+			time = self.clock + delay
+			tasks = self.postponed.get(time)
+			if tasks is None:
+				# First task due at this time
+				self.postponed[time] = deque((c,))
+				heappush(self.postponed_times, time)
+			else:
+				tasks.append(c)
+	
+	
+	def set_timer(self, c, delay = 0):
+		"""
+		Call the callable c after delay cycles, as do_later() does. Returns a Timer
+		which can be used to cancel or reschedule the call.
+		"""
+		timer = Timer(self, c)
+		self.schedule(timer, delay)
+		return timer
+	
+	
+	def schedule(self, timer, delay = 0):
+		"""
+		Schedule a Timer to be called after delay cycles (see set_timer()).
+		"""
+		timer.due = self.clock + delay
+		self.do_later(timer, delay)
+	
+	
+	def record_load(self):
+		"""
+		Start recording the number of tasks executed in each cycle which can later
+		be retrieved with get_load(). Skipped (idle) cycles are not recorded.
+		"""
+		self.load_clocks   = array("L")
+		self.load_due      = array("L")
+		self.load_executed = array("L")
+		self._record_cycle(len(self.ready) + len(self.inactive))
+	
+	
+	def get_load(self):
+		"""
+		Get a list of (clock, num_due, num_executed) tuples for each cycle since
+		record_load() was called. num_due is the number of tasks due at the start of
+		the cycle and num_executed the total number of tasks executed in it
+		(including any scheduled during the cycle).
+		"""
+		executed = self.load_executed.tolist() + [self.num_executed]
+		return [ (clock, due, executed[i+1] - executed[i])
+		         for i, (clock, due) in enumerate(zip(self.load_clocks, self.load_due))
+		       ]
+	
+	
+	def _record_cycle(self, num_due):
+		"""
+		Record the start of a cycle (at the current clock) in the load statistics.
+		"""
+		self.load_clocks.append(self.clock)
+		self.load_due.append(num_due)
+		self.load_executed.append(self.num_executed)
+	
+	
+	def trace_event(self, owner, kind, packet = None):
+		"""
+		Record an event of the given kind (a string) occurring now in the trace, if
+		one is set. owner is the component the event occurred in and packet the
+		packet (if any) involved.
+		"""
+		if self.trace is not None:
+			self.trace.record(self.clock, owner, kind,
+			                  None if packet is None else packet.id)
+	
+	
+	def do_every(self, c, period, delay = None, on_skip = None):
+		"""
+		Call the callable c every period cycles, starting after delay cycles
+		(defaults to period). If the delay is zero the callable is first called in
+		the current cycle. Returns a PeriodicTask.
+		
+		on_skip is an optional callable which allows calls to c to be skipped while
+		the idle_test holds. It is called with the number of calls skipped and
+		should account for the effect those calls would have had.
+		"""
+		
+		assert(period > 0)
+		
+		if delay is None:
+			delay = period
+		assert(delay >= 0)
+		
+		time  = self.clock + delay
+		phase = time % period
+		for group in self.periodic_groups:
+			if group.period == period and group.phase == phase:
+				break
+		else:
+			group = PeriodicGroup(period, phase, self.batch_handlers)
+			self.periodic_groups.append(group)
+		
+		task = PeriodicTask(self, group, c, on_skip)
+		task.next_time = time
+		task.resume()
+		return task
+	
+	
+	def set_batch_handler(self, method, handler):
+		"""
+		Rather than calling each periodic task which is the given unbound method
+		(e.g. SpiNNakerRouter.do_route) of an object individually, call handler
+		with the list of objects whose tasks are due, in the order the tasks were
+		registered. The handler must behave as if the method were called on each
+		object in turn.
+		
+		The batch is called in place of the first of the tasks it replaces. This
+		reorders tasks of different kinds due in the same cycle which the ready
+		queue allows. Batch handlers must be picklable (e.g. module-level
+		functions) for the scheduler to be checkpointed.
+		"""
+		self.batch_handlers[(method.im_class, method.__name__)] = handler
+		for group in self.periodic_groups:
+			group.dispatch_list = None
+	
+	
+	def _next_postponed_time(self, before = None):
+		"""
+		The next time at which any postponed tasks are due or None if none are.
+		Implementations may return any time at or after before (if given) when no
+		task is due before then.
+		"""
+		return self.postponed_times[0] if self.postponed_times else None
+	
+	
+	def _next_time(self):
+		"""
+		The next time at which any tasks are due or None if no tasks are due.
+		"""
+		time = None
+		for group in self.periodic_groups:
+			if group.num_active and (time is None or group.next_time < time):
+				time = group.next_time
+		
+		postponed_time = self._next_postponed_time(time)
+		if postponed_time is not None and (time is None or postponed_time < time):
+			time = postponed_time
+		
+		return time
+	
+	
+	def _skip_idle(self, limit = None, on_clock_edge = None):
+		"""
+		Skip over the cycles before the next postponed or unskippable periodic task
+		is due (or the limit, if given), calling the on_skip of the periodic tasks
+		skipped. The clock is advanced to the last cycle skipped.
+		
+		If on_clock_edge is given, it is called once for the whole span skipped as
+		if the last cycle skipped were being simulated: the tasks due before that
+		cycle are skipped, the clock advanced to it and on_clock_edge called, the
+		tasks due in it being skipped afterwards by _skip_groups(). Returns True if
+		cycles were skipped this way.
+		"""
+		time = None
+		for group in self.periodic_groups:
+			if group.num_unskippable and (time is None or group.next_time < time):
+				time = group.next_time
+		
+		postponed_time = self._next_postponed_time(time)
+		if postponed_time is not None and (time is None or postponed_time < time):
+			time = postponed_time
+		
+		if limit is not None and (time is None or limit < time):
+			time = limit
+		
+		if time is None:
+			# Nothing but skippable tasks, forever
+			return False
+		
+		if on_clock_edge is not None:
+			# The last cycle in which any group is due
+			groups = [ group for group in self.periodic_groups
+			           if group.num_active and group.next_time < time ]
+			if not groups:
+				return False
+			last = max( group.next_time
+			            + ((time - 1 - group.next_time) // group.period) * group.period
+			            for group in groups)
+			
+			for group in groups:
+				group.skip(last)
+			self.clock = last
+			self.skipping_groups = [ group for group in groups
+			                         if group.next_time == last ]
+			on_clock_edge()
+			return True
+		
+		for group in self.periodic_groups:
+			if group.num_active:
+				last_skipped = group.skip(time)
+				if last_skipped is not None and last_skipped > self.clock:
+					self.clock = last_skipped
+		
+		return False
+	
+	
+	def _skip_groups(self):
+		"""
+		Skip the tasks due in the current cycle (the last of a span skipped by
+		_skip_idle()) once the clock edge hook has been called.
+		"""
+		for group in self.skipping_groups:
+			group.skip(self.clock + 1)
+		self.skipping_groups = []
+	
+	
+	def _pop_postponed(self, time):
+		"""
+		Remove and return the deque of postponed tasks due at the given time (which
+		may be empty).
+		"""
+		if self.postponed_times and self.postponed_times[0] == time:
+			heappop(self.postponed_times)
+			return self.postponed.pop(time)
+		else:
+			return deque()
+	
+	
+	def _advance(self, time):
+		"""
+		Advance the clock to the given time and mark the tasks due then as ready to
+		run.
+		"""
+		self.clock = time
+		self.ready = self._pop_postponed(time)
+		
+		# The number of tasks dispatched in Batches beyond the Batches themselves
+		num_batched = 0
+		
+		for group in self.periodic_groups:
+			if group.num_active and group.next_time == time:
+				dispatch_list = group.dispatch()
+				self.ready.extend(dispatch_list)
+				num_batched += group.num_active - len(dispatch_list)
+		
+		if self.load_clocks is not None:
+			self._record_cycle(len(self.ready) + num_batched)
+		
+		# Batches are counted as one task when executed
+		self.num_executed += num_batched
 	
 	
 	def run(self):
@@ -50,23 +773,166 @@ class Scheduler(object):
 		Yields the current clock value after each call to a task.
 		"""
 		
-		while self.ready or self.inactive or self.postponed:
+		while True:
 			while self.ready or self.inactive:
 				# Execute ready tasks
 				while self.ready:
-					self.ready.pop(0)()
+					self.ready.popleft()()
+					self.num_executed += 1
 					yield self.clock
 				
 				# Make inactive tasks ready to run (edge-case: unless someone added a
 				# ready task while we were yielded...)
 				if not self.ready:
 					self.ready    = self.inactive
-					self.inactive = []
+					self.inactive = deque()
 			
-			# Advance the clock to the next set of postponed tasks and mark them as
-			# ready to run
-			if self.postponed:
-				self.clock = min(self.postponed.iterkeys())
-				self.ready = self.postponed.pop(self.clock)
-			else:
+			# Advance the clock to the next set of due tasks and mark them as ready to
+			# run
+			if self.idle_test is not None and self.idle_test():
+				self._skip_idle()
+			time = self._next_time()
+			if time is None:
 				return
+			self._advance(time)
+	
+	
+	def run_until(self, cycle, on_clock_edge = None):
+		"""
+		Run the scheduler until all tasks due before the given cycle have been
+		executed or no further tasks are due to be executed. Tasks are executed in
+		a tight loop rather than yielding after each one as run() does. Returns the
+		current clock value.
+		
+		on_clock_edge is an optional callable which is called with no arguments
+		each time the clock advances, before any tasks in the new cycle are
+		executed. Each span of cycles skipped while idle (see idle_test) is skipped
+		in one step: the hook is called once, with the clock at the last cycle
+		skipped, before the tasks due in that cycle are skipped. The cycles skipped
+		before it can be found from the clock at the previous call.
+		
+		If stop() is called, returns at the end of the current cycle instead.
+		
+		The simulation may be continued by calling run_until() again with a later
+		cycle.
+		"""
+		
+		profiler = self.profiler
+		
+		while True:
+			while self.ready or self.inactive:
+				# Execute ready tasks. Each batch is swapped out for a fresh queue so
+				# that tasks added while it runs end up in the next batch (preserving
+				# FIFO order) and the batch can simply be iterated over.
+				while self.ready:
+					batch = self.ready
+					self.ready = deque()
+					if profiler is None:
+						for task in batch:
+							task()
+					else:
+						profiler.execute(batch)
+					self.num_executed += len(batch)
+				
+				# Make inactive tasks ready to run
+				self.ready    = self.inactive
+				self.inactive = deque()
+			
+			# Finish skipping the cycle
+			if self.skipping_groups:
+				self._skip_groups()
+			
+			if self.stopping:
+				self.stopping = False
+				return self.clock
+			
+			# Advance the clock to the next set of due tasks (if they're due before
+			# the given cycle) and mark them as ready to run
+			if self.idle_test is not None and self.idle_test():
+				if self._skip_idle(cycle, on_clock_edge):
+					continue
+			time = self._next_time()
+			if time is None or time >= cycle:
+				return self.clock
+			self._advance(time)
+			
+			if on_clock_edge is not None:
+				on_clock_edge()
+
+
+
+class TimingWheelScheduler(Scheduler):
+	"""
+	A scheduler whose postponed queue is a timing wheel: a ring of wheel_size
+	task deques indexed by time modulo wheel_size. Tasks due within wheel_size
+	cycles are inserted directly into their slot while tasks due further in the
+	future are kept in the (heap-based) postponed queue of the Scheduler.
+	
+	A bitmap of the occupied slots allows the next one to be found without
+	visiting the empty slots in between.
+	
+	Tasks are executed in exactly the same order as the Scheduler.
+	"""
+	
+	def __init__(self, wheel_size = 256):
+		Scheduler.__init__(self)
+		
+		self.wheel_size = wheel_size
+		self.wheel      = [deque() for _ in xrange(wheel_size)]
+		
+		# A bitmap (an int) with bit n set when slot n of the wheel is non-empty
+		self.occupied = 0
+	
+	
+	def do_later(self, c, delay = 0):
+		"""
+		Call the callable c after delay cycles. Tasks due within wheel_size cycles
+		are placed in the wheel, others in the postponed queue.
+		"""
+		
+		if 0 < delay < self.wheel_size:
+			slot  = (self.clock + delay) % self.wheel_size
+			tasks = self.wheel[slot]
+			if not tasks:
+				self.occupied |= 1 << slot
+			tasks.append(c)
+		else:
+			Scheduler.do_later(self, c, delay)
+	
+	
+	def _next_postponed_time(self, before = None):
+		time = Scheduler._next_postponed_time(self)
+		
+		if self.occupied:
+			# The first occupied slot after the current one (which is always empty),
+			# wrapping around to the start of the wheel if there are none
+			start = (self.clock + 1) % self.wheel_size
+			later = self.occupied >> start
+			if later:
+				slot = start + (later & -later).bit_length() - 1
+			else:
+				slot = (self.occupied & -self.occupied).bit_length() - 1
+			
+			wheel_time = self.clock + (slot - self.clock) % self.wheel_size
+			if time is None or wheel_time < time:
+				time = wheel_time
+		
+		return time
+	
+	
+	def _pop_postponed(self, time):
+		# Tasks in the postponed queue were scheduled at least wheel_size cycles
+		# before those in the wheel and so come first.
+		ready = Scheduler._pop_postponed(self, time)
+		
+		slot  = time % self.wheel_size
+		tasks = self.wheel[slot]
+		if tasks:
+			self.wheel[slot] = deque()
+			self.occupied &= ~(1 << slot)
+			if ready:
+				ready.extend(tasks)
+			else:
+				ready = tasks
+		
+		return ready
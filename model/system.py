@@ -23,8 +23,17 @@ class SpiNNakerSystem(object):
 		# A list of all packets placed into the system
 		self.packets = []
 		
+		# The number of packets which have been created but not yet received or
+		# dropped
+		self.packets_in_flight = 0
+		
+		# The routers which are asleep (see SpiNNakerRouter.sleep_if_blocked())
+		self.sleeping_routers = set()
+		
 		self.time_phase = None
 		self.advance_timephase()
+		self.time_phase_task = self.scheduler.do_every(self.advance_timephase,
+		                                               self.time_phase_period)
 	
 	
 	def advance_timephase(self):
@@ -38,6 +47,22 @@ class SpiNNakerSystem(object):
 			0b11: 0b10,
 			0b10: 0b00,
 		}[self.time_phase]
-		
-		self.scheduler.do_later(self.advance_timephase, self.time_phase_period)
+	
+	
+	def catch_up(self, time):
+		"""
+		Account for the routing steps skipped by sleeping routers before the given
+		time (see SpiNNakerRouter.catch_up()) so that their counters and the waits of
+		their packets are up to date.
+		"""
+		for router in self.sleeping_routers:
+			router.catch_up(time)
+	
+	
+	def is_quiescent(self):
+		"""
+		Returns True when no packets are in flight and so the routers and links of
+		the system have nothing to do. Suitable for use as a scheduler idle_test.
+		"""
+		return self.packets_in_flight == 0
 
@@ -10,7 +10,24 @@ import unittest
 
 from itertools import product
 
+from cStringIO import StringIO
+
+import os
+import sys
+import shutil
+import tempfile
+
+from random import Random
+from random import seed
+from random import getstate
+from random import setstate
+
 from scheduler import Scheduler
+from scheduler import TimingWheelScheduler
+
+from profiler import Profiler
+
+from tracing import Trace
 
 from link import SilistixLink
 from link import DeadLink
@@ -30,8 +47,17 @@ from top import SpiNNaker101
 from top import SpiNNaker103
 from top import SpiNNakerTorus
 
+from checkpoint import save_checkpoint
+from checkpoint import load_checkpoint
+
+from parallel import ParallelEngine
+
 import topology
 
+# The experiment framework lives in the directory above
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from experiment import Simulation
+
 class SchedulerTests(unittest.TestCase):
 	"""
 	Tests the scheduler does something sensible.
@@ -90,6 +116,430 @@ class SchedulerTests(unittest.TestCase):
 		                and     much_later_called[0])
 		
 		self.assertRaises(StopIteration, iterator.next)
+	
+	def test_do_later_order(self):
+		# Postponed tasks run in time order regardless of the order in which they
+		# were scheduled
+		
+		called = []
+		
+		s = Scheduler()
+		for delay in (30, 10, 20, 10, 5):
+			s.do_later((lambda delay=delay: called.append(delay)), delay)
+		
+		iterator = s.run()
+		
+		self.assertEqual(list(iterator), [5, 10, 10, 20, 30])
+		self.assertEqual(called, [5, 10, 10, 20, 30])
+	
+	def test_queue_order(self):
+		# Tasks in each queue run in the order they were added and inactive tasks
+		# only run once the ready queue is empty
+		
+		called = []
+		
+		s = Scheduler()
+		def task(name, then = None):
+			def f():
+				called.append(name)
+				if then is not None:
+					then()
+			return f
+		
+		s.do_now(task("now0", lambda: s.do_later(task("inactive1"))))
+		s.do_later(task("inactive0", lambda: s.do_now(task("now2"))))
+		s.do_now(task("now1"))
+		s.do_later(task("later0"), 1)
+		s.do_later(task("later1"), 1)
+		
+		self.assertEqual(list(s.run()), [0]*5 + [1]*2)
+		self.assertEqual(called, [ "now0", "now1"
+		                         , "inactive0", "inactive1"
+		                         , "now2"
+		                         , "later0", "later1"
+		                         ])
+	
+	def test_run_until(self):
+		# Tasks due before the given cycle are executed without yielding and the
+		# clock edge callback is called whenever the clock advances
+		
+		called = []
+		edges  = []
+		
+		s = Scheduler()
+		def task():
+			called.append(s.clock)
+			s.do_later(task, 5)
+		s.do_now(task)
+		
+		self.assertEqual(s.run_until(12, (lambda: edges.append(s.clock))), 10)
+		self.assertEqual(called, [0, 5, 10])
+		self.assertEqual(edges,  [5, 10])
+		self.assertEqual(s.num_executed, 3)
+		
+		# Can continue where we left off
+		self.assertEqual(s.run_until(16), 15)
+		self.assertEqual(called, [0, 5, 10, 15])
+		self.assertEqual(edges,  [5, 10])
+		
+		# Stops when nothing is left to do
+		s = Scheduler()
+		s.do_later(lambda: None, 3)
+		self.assertEqual(s.run_until(100), 3)
+	
+	
+	def test_do_every(self):
+		# Periodic tasks are called every period cycles after any postponed tasks
+		# due in the same cycle
+		log = []
+		s = Scheduler()
+		s.do_every((lambda: log.append(("a", s.clock))), 2)
+		s.do_every((lambda: log.append(("b", s.clock))), 3, 0)
+		s.do_later((lambda: log.append(("x", s.clock))), 2)
+		
+		self.assertEqual(s.run_until(7), 6)
+		self.assertEqual(log, [ ("b", 0), ("x", 2), ("a", 2), ("b", 3), ("a", 4)
+		                      , ("a", 6), ("b", 6)
+		                      ])
+		self.assertEqual(s.num_executed, 7)
+		
+		# A task starting later than others with the same period and phase joins
+		# them when first due
+		log = []
+		s = Scheduler()
+		s.do_every((lambda: log.append(("a", s.clock))), 4)
+		s.do_every((lambda: log.append(("b", s.clock))), 4, 8)
+		s.run_until(13)
+		self.assertEqual(log, [ ("a", 4), ("a", 8), ("b", 8), ("a", 12), ("b", 12)])
+	
+	
+	def test_periodic_pause(self):
+		called = []
+		s = Scheduler()
+		t = s.do_every((lambda: called.append(s.clock)), 4)
+		
+		# Resumes on its original schedule
+		s.do_later(t.pause, 5)
+		s.do_later(t.resume, 10)
+		
+		# Resuming in a cycle where the task is due still calls it
+		s.do_later(t.pause, 13)
+		s.do_later(t.resume, 16)
+		
+		# Pausing and resuming in a cycle where the task has been dispatched doesn't
+		# call it twice
+		s.do_later(t.pause, 20)
+		s.do_later(t.resume, 20)
+		
+		# Nothing left to do once stopped
+		s.do_later(t.stop, 25)
+		
+		self.assertEqual(s.run_until(100), 25)
+		self.assertEqual(called, [4, 12, 16, 20, 24])
+	
+	
+	def test_timer(self):
+		called = []
+		s = Scheduler()
+		s.profiler = Profiler()
+		
+		# Cancelled timers do nothing
+		t1 = s.set_timer((lambda: called.append(("t1", s.clock))), 5)
+		t2 = s.set_timer((lambda: called.append(("t2", s.clock))), 5)
+		t3 = s.set_timer((lambda: called.append(("t3", s.clock))))
+		self.assertTrue(t1.is_pending())
+		t1.cancel()
+		self.assertFalse(t1.is_pending())
+		
+		# Rescheduling replaces the original time
+		t2.reschedule(2)
+		
+		# Can be rescheduled once called
+		s.do_later((lambda: t3.reschedule()), 10)
+		
+		s.run_until(100)
+		self.assertEqual(called, [("t3", 0), ("t2", 2), ("t3", 10)])
+		self.assertFalse(t2.is_pending())
+		self.assertFalse(t3.is_pending())
+		
+		# The tombstones left at time 5 aren't counted as executed
+		self.assertEqual(s.num_executed, 4)
+		self.assertEqual(dict(s.profiler.calls), {"<lambda>": 4})
+	
+	
+	def test_batch_handler(self):
+		log = []
+		
+		class Component(object):
+			def __init__(self, name):
+				self.name = name
+			def tick(self):
+				log.append(self.name)
+		
+		def tick_batch(components):
+			log.append([c.name for c in components])
+		
+		s = Scheduler()
+		s.set_batch_handler(Component.tick, tick_batch)
+		
+		# Batched tasks are called in place of the first of them and unbatched tasks
+		# in their usual order
+		a, b, c = Component("a"), Component("b"), Component("c")
+		s.do_every(a.tick, 1)
+		s.do_every((lambda: log.append("x")), 1)
+		s.do_every(b.tick, 1)
+		c_task = s.do_every(c.tick, 1)
+		s.run_until(2)
+		self.assertEqual(log, [["a", "b", "c"], "x"])
+		
+		# Paused tasks leave the batch
+		del log[:]
+		c_task.pause()
+		s.run_until(3)
+		self.assertEqual(log, [["a", "b"], "x"])
+	
+	
+	def test_batch_dispatch_updates(self):
+		# The dispatch list is kept up to date as tasks are paused and resumed
+		# (including by the batch being called) exactly as if it were rebuilt
+		def run(rebuild):
+			log = []
+			rng = Random(0)
+			s = Scheduler()
+			
+			class Component(object):
+				def __init__(self, name):
+					self.name = name
+				def tick(self):
+					log.append(self.name)
+			
+			def tick_batch(components):
+				log.append([c.name for c in components])
+				if rebuild:
+					for group in s.periodic_groups:
+						group.dispatch_list = None
+				for _ in range(2):
+					change()
+			
+			s.set_batch_handler(Component.tick, tick_batch)
+			
+			tasks = []
+			for num in range(20):
+				if num % 4 == 3:
+					c = (lambda num=num: log.append(num))
+				else:
+					c = Component(num).tick
+				tasks.append(s.do_every(c, 1, 0))
+			
+			def change():
+				task = rng.choice(tasks)
+				if task.active:
+					task.pause()
+				else:
+					task.resume()
+			
+			def on_clock_edge():
+				if rebuild:
+					for group in s.periodic_groups:
+						group.dispatch_list = None
+				change()
+			
+			s.run_until(200, on_clock_edge)
+			return log
+		
+		self.assertEqual(run(False), run(True))
+	
+	
+	def test_skip_idle(self):
+		# While idle, periodic tasks with an on_skip are skipped up to the next
+		# postponed or unskippable task or the end of the run
+		called  = []
+		skipped = []
+		s = Scheduler()
+		s.idle_test = (lambda: True)
+		s.do_every((lambda: None), 1, on_skip = skipped.append)
+		s.do_every((lambda: called.append(s.clock)), 4)
+		s.do_later((lambda: called.append(s.clock)), 6)
+		
+		self.assertEqual(s.run_until(10), 9)
+		self.assertEqual(called, [4, 6, 8])
+		self.assertEqual(skipped, [3, 1, 1, 1])
+		self.assertEqual(s.num_executed, 6)
+	
+	
+	def test_skip_idle_clock_edge(self):
+		# A clock edge hook is called once for each span of cycles skipped, at its
+		# last cycle, seeing the same state as when nothing is skipped
+		def run(idle):
+			edges = []
+			count = [0]
+			def step(num = 1):
+				count[0] += num
+			s = Scheduler()
+			if idle:
+				s.idle_test = (lambda: True)
+			s.do_every(step, 1, on_skip = step)
+			s.do_every((lambda: None), 4)
+			s.do_later((lambda: None), 6)
+			on_clock_edge = (lambda: edges.append((s.clock, count[0])))
+			self.assertEqual(s.run_until(10, on_clock_edge), 9)
+			return edges, count[0]
+		
+		edges, count = run(False)
+		self.assertEqual(run(True), ([edge for edge in edges
+		                              if edge[0] in (3, 4, 5, 6, 7, 8, 9)], count))
+		
+		# Stopping in a skipped span returns at the end of it
+		s = Scheduler()
+		s.idle_test = (lambda: True)
+		s.do_every((lambda: None), 1, on_skip = (lambda num: None))
+		s.do_every((lambda: None), 4)
+		self.assertEqual(s.run_until(10, (lambda: s.clock == 3 and s.stop())), 3)
+		self.assertEqual(s.run_until(10), 9)
+	
+	
+	def test_profiler(self):
+		# Tasks are attributed to their class and method or function
+		class Component(object):
+			def tick(self):
+				pass
+		
+		def event():
+			pass
+		
+		s = Scheduler()
+		s.profiler = Profiler()
+		c = Component()
+		s.do_every(c.tick, 1)
+		s.do_later(event, 3)
+		s.do_later(c.tick, 3)
+		s.do_now((lambda: None))
+		s.run_until(5)
+		
+		self.assertEqual(dict(s.profiler.calls), { "Component.tick" : 5
+		                                         , "event" : 1
+		                                         , "<lambda>" : 1
+		                                         })
+		self.assertEqual(s.num_executed, 7)
+	
+	
+	def test_trace(self):
+		class Packet(object):
+			def __init__(self, id):
+				self.id = id
+		
+		s = Scheduler()
+		owner = object()
+		
+		# Nothing is recorded without a trace
+		s.trace_event(owner, "ignored")
+		
+		# Only the last three events are kept
+		s.trace = Trace(3)
+		self.assertEqual(s.trace.get_events(), [])
+		for time in range(5):
+			s.do_later((lambda: s.trace_event(owner, "event", Packet(s.clock))), time)
+		s.do_later((lambda: s.trace_event(owner, "end")), 5)
+		s.run_until(10)
+		
+		self.assertEqual(s.trace.get_events(), [ (3, owner, "event", 3)
+		                                        , (4, owner, "event", 4)
+		                                        , (5, owner, "end", None)
+		                                        ])
+		self.assertEqual(s.trace.num_recorded, 6)
+	
+	
+	def test_record_load(self):
+		s = Scheduler()
+		
+		# A task every other cycle which schedules another for the same cycle
+		def task():
+			s.do_later((lambda: None))
+		s.do_every(task, 2, 0)
+		s.do_later((lambda: None), 3)
+		
+		s.record_load()
+		s.run_until(5)
+		
+		self.assertEqual(s.get_load(), [ (0, 1, 2)
+		                                , (2, 1, 2)
+		                                , (3, 1, 1)
+		                                , (4, 1, 2)
+		                                ])
+	
+	
+	def test_batch_load(self):
+		# Tasks called by a batch handler are counted and profiled individually
+		class Component(object):
+			def tick(self):
+				pass
+		
+		def tick_batch(components):
+			pass
+		
+		s = Scheduler()
+		s.set_batch_handler(Component.tick, tick_batch)
+		s.profiler = Profiler()
+		s.do_every(Component().tick, 1, 0)
+		s.do_every(Component().tick, 1, 0)
+		s.do_every(Component().tick, 2, 0)
+		s.do_every((lambda: None), 2, 0)
+		
+		s.record_load()
+		s.run_until(3)
+		
+		self.assertEqual(s.get_load(), [ (0, 4, 4)
+		                                , (1, 2, 2)
+		                                , (2, 4, 4)
+		                                ])
+		self.assertEqual(s.num_executed, 10)
+		self.assertEqual(dict(s.profiler.calls), { "Component.tick" : 8
+		                                         , "<lambda>" : 2
+		                                         })
+	
+	
+	def test_stop(self):
+		s = Scheduler()
+		
+		log = []
+		def task():
+			log.append(s.clock)
+			s.do_later((lambda: log.append(-s.clock)))
+			if s.clock == 3:
+				s.stop()
+		s.do_every(task, 1, 0)
+		
+		# Stops at the end of the cycle in which stop() was called
+		self.assertEqual(s.run_until(10), 3)
+		self.assertEqual(log, [0, 0, 1, -1, 2, -2, 3, -3])
+		
+		# And may be continued
+		self.assertEqual(s.run_until(6), 5)
+		self.assertEqual(log[8:], [4, -4, 5, -5])
+	
+	
+	def test_timing_wheel(self):
+		# The timing wheel scheduler executes tasks in exactly the same order as the
+		# normal scheduler, including those delayed beyond the size of the wheel.
+		def run(s):
+			log = []
+			rng = Random(0)
+			
+			def make_task(num):
+				def task():
+					log.append((num, s.clock))
+					if len(log) < 2000:
+						s.do_later(task, rng.choice([0, 1, 2, 15, 16, 17, 40]))
+				return task
+			
+			for num in range(20):
+				s.do_later(make_task(num), rng.randint(0, 40))
+			s.do_every(make_task("p"), 3)
+			
+			s.run_until(1000)
+			return log
+		
+		self.assertEqual(run(TimingWheelScheduler(16)), run(Scheduler()))
 
 
 
@@ -117,7 +567,11 @@ class LinkTests(unittest.TestCase):
 		# Can't send after sending something
 		self.assertFalse(sl.can_send())
 		self.assertFalse(sl.can_receive())
+		self.assertEqual(sl.get_state(), SilistixLink.SENDING)
 		
+		# Didn't schedule anything: the state follows the clock
+		self.assertRaises(StopIteration, s.run().next)
+		s.do_every((lambda: None), 1)
 		it = s.run()
 		
 		# Can't send or recieve until send delay has elapsed
@@ -128,6 +582,7 @@ class LinkTests(unittest.TestCase):
 		# Can only recieve once data is stable
 		self.assertFalse(sl.can_send())
 		self.assertTrue(sl.can_receive())
+		self.assertEqual(sl.get_state(), SilistixLink.STABLE)
 		
 		# Can peek
 		self.assertEqual(sl.peek().data, 123)
@@ -143,6 +598,7 @@ class LinkTests(unittest.TestCase):
 		# Can't recieve any more
 		self.assertFalse(sl.can_send())
 		self.assertFalse(sl.can_receive())
+		self.assertEqual(sl.get_state(), SilistixLink.ACKING)
 		
 		# Can't send or recieve until Acknowledge arrives
 		while it.next() != 10*2 + 5*2:
@@ -152,9 +608,7 @@ class LinkTests(unittest.TestCase):
 		# Can send once ack is back
 		self.assertTrue(sl.can_send())
 		self.assertFalse(sl.can_receive())
-		
-		# Nothing else got scheduled...
-		self.assertRaises(StopIteration, it.next)
+		self.assertEqual(sl.get_state(), SilistixLink.READY)
 	
 	
 	def test_dead_link(self):
@@ -219,9 +673,46 @@ class LinkTests(unittest.TestCase):
 		self.assertTrue(bl.can_send())
 		self.assertFalse(bl.can_receive())
 		
+		# Wraps around the end of the buffer
+		for data in range(10):
+			bl.send(data)
+			self.assertEqual(bl.peek(), data)
+			self.assertEqual(bl.receive(), data)
+		bl.send(1)
+		bl.send(2)
+		self.assertFalse(bl.can_send())
+		self.assertEqual(bl.receive(), 1)
+		self.assertEqual(bl.receive(), 2)
+		
+		# Records the most packets held at once
+		self.assertEqual(bl.high_water_mark, 2)
+		
 		# Didn't schedule anything
 		self.assertRaises(StopIteration, s.run().next)
 	
+	
+	def test_unbounded_buffer_link(self):
+		s = Scheduler()
+		bl = BufferLink(s)
+		
+		# Never fills up
+		for data in range(100):
+			self.assertTrue(bl.can_send())
+			bl.send(data)
+		self.assertEqual(bl.high_water_mark, 100)
+		
+		# In queue order
+		for data in range(100):
+			self.assertTrue(bl.can_receive())
+			self.assertEqual(bl.peek(), data)
+			self.assertEqual(bl.receive(), data)
+		self.assertFalse(bl.can_receive())
+		
+		# The high-water mark remains
+		bl.send(0)
+		self.assertEqual(bl.high_water_mark, 100)
+	
+	
 	def test_delay_line_link(self):
 		s = Scheduler()
 		sys = SpiNNakerSystem(s, 1000)
@@ -234,9 +725,11 @@ class LinkTests(unittest.TestCase):
 		self.assertFalse(dll.can_receive())
 		self.assertTrue(dll.can_send())
 		
+		# The link schedules nothing itself so keep the clock ticking
+		s.do_every((lambda: None), 1)
 		it = s.run()
 		
-		# Does nothing (but keeps scheduling things) if we give it nothing to do
+		# Does nothing if we give it nothing to do
 		while it.next() < 100:
 			self.assertFalse(dll.can_receive())
 			self.assertTrue(dll.can_send())
@@ -249,17 +742,14 @@ class LinkTests(unittest.TestCase):
 		self.assertFalse(dll.can_receive())
 		self.assertTrue(dll.can_send())
 		
-		# Nothing arrives in four cycles
-		while it.next() <= 104:
+		# Nothing arrives during the next five cycles
+		while it.next() <= 105:
 			self.assertFalse(dll.can_receive())
 			self.assertTrue(dll.can_send())
 		
-		# Something arrives in the fifth cycle
-		arrived = False
-		while it.next() <= 105:
-			arrived = arrived or dll.can_receive()
-			self.assertTrue(dll.can_send())
-		self.assertTrue(arrived and dll.can_receive())
+		# Something arrives in the sixth cycle
+		self.assertEqual(s.clock, 106)
+		self.assertTrue(dll.can_receive())
 		
 		# Can still receive even if we leave it a moment...
 		while it.next() < 150:
@@ -272,6 +762,116 @@ class LinkTests(unittest.TestCase):
 		self.assertTrue(dll.can_send())
 	
 	
+	def test_arrival_listener(self):
+		s = Scheduler()
+		sys = SpiNNakerSystem(s, 1000)
+		p = SpiNNakerP2PPacket(sys, "Data", (0,0), 1)
+		
+		for link, arrival_delay in ( (SilistixLink(s, 3, 1), 3)
+		                           , (BufferLink(s, 2),      0)
+		                           , (BufferLink(s),         0)
+		                           , (DelayLineLink(s, 10),  11)
+		                           ):
+			calls = []
+			link.set_arrival_listener(calls.append)
+			
+			# Called with the time the packet can be received
+			start = s.clock
+			link.send(p)
+			self.assertEqual(calls, [start + arrival_delay])
+			
+			# Only when the link had nothing to receive
+			if link.can_send():
+				link.send(p)
+				self.assertEqual(len(calls), 1)
+			
+			# The packet arrives when promised
+			while not link.can_receive():
+				s.clock += 1
+			self.assertEqual(s.clock, start + arrival_delay)
+			
+			def empty():
+				while link.can_receive() or not link.can_send():
+					if link.can_receive():
+						link.receive()
+					s.clock += 1
+			
+			# Called again once emptied
+			empty()
+			link.send(p)
+			self.assertEqual(len(calls), 2)
+			
+			# Can be removed
+			link.set_arrival_listener(None)
+			empty()
+			link.send(p)
+			self.assertEqual(len(calls), 2)
+		
+		# Channels of SATALinks call the listener when a packet leaves the link
+		sata_link = SATALink(s, 2, 1, 1, 10, 3, 1)
+		s.do_every((lambda: None), 1)
+		for channel in (sata_link.get_channel_link(0), sata_link.get_channel_proxy(1)):
+			calls = []
+			channel.set_arrival_listener(calls.append)
+			channel.send(p)
+			
+			end = s.clock + 100
+			while not channel.can_receive():
+				s.run_until(s.clock + 2)
+				self.assertTrue(s.clock < end)
+			self.assertEqual(calls, [s.clock])
+	
+	
+	def test_space_listener(self):
+		s = Scheduler()
+		sys = SpiNNakerSystem(s, 1000)
+		p = SpiNNakerP2PPacket(sys, "Data", (0,0), 1)
+		
+		for link, ack_delay in ( (SilistixLink(s, 3, 2), 2)
+		                       , (BufferLink(s, 1),      0)
+		                       ):
+			calls = []
+			link.set_space_listener(calls.append)
+			
+			# Not called while the link is filled
+			self.assertEqual(link.next_free_time(), s.clock)
+			link.send(p)
+			self.assertFalse(link.can_send())
+			self.assertEqual(link.next_free_time(), None)
+			while not link.can_receive():
+				s.clock += 1
+			self.assertEqual(calls, [])
+			
+			# Called with the time the link can be sent down once emptied
+			link.receive()
+			self.assertEqual(calls, [s.clock + ack_delay])
+			self.assertEqual(link.next_free_time(), s.clock + ack_delay)
+			s.clock += ack_delay
+			self.assertTrue(link.can_send())
+		
+		# Links which are never full never call it
+		link = BufferLink(s)
+		calls = []
+		link.set_space_listener(calls.append)
+		link.send(p)
+		link.receive()
+		self.assertEqual(calls, [])
+		
+		# Channels of SATALinks call the listener when a packet enters the link
+		sata_link = SATALink(s, 2, 1, 1, 10, 3, 1)
+		s.do_every((lambda: None), 1)
+		for channel in (sata_link.get_channel_link(0), sata_link.get_channel_proxy(1)):
+			calls = []
+			channel.set_space_listener(calls.append)
+			channel.send(p)
+			
+			end = s.clock + 100
+			while not calls:
+				s.run_until(s.clock + 2)
+				self.assertTrue(s.clock < end)
+			self.assertEqual(channel.next_free_time(), calls[0])
+	
+	
 	def test_sata_link(self):
 		s = Scheduler()
 		sys = SpiNNakerSystem(s, 1000)
@@ -291,6 +891,8 @@ class LinkTests(unittest.TestCase):
 		
 		channels = [dll.get_channel_link(n) for n in range(num_channels)]
 		
+		# The link's handler sleeps while it is idle so keep the clock ticking
+		s.do_every((lambda: None), 1)
 		it = s.run()
 		it_next = 0
 		
@@ -356,6 +958,112 @@ class LinkTests(unittest.TestCase):
 		# Other channels are not
 		for c in channels[1:]:
 			self.assertTrue(c.can_send())
+	
+	
+	def test_sata_link_channel(self):
+		s = Scheduler()
+		sys = SpiNNakerSystem(s, 1000)
+		dll = SATALink(s, 2, 1, 1, 10, 3, 1)
+		
+		# The channel link calls the channel's SilistixLinks directly
+		channel = dll.get_channel_link(1)
+		self.assertEqual(channel.send,    dll.in_links[1].send)
+		self.assertEqual(channel.receive, dll.out_links[1].receive)
+		
+		# ...and behaves as a proxy does
+		proxy = dll.get_channel_proxy(1)
+		p = SpiNNakerP2PPacket(sys, "Data", (0,0), 1)
+		channel.send(p)
+		self.assertFalse(proxy.can_send())
+		
+		s.do_every((lambda: None), 1)
+		s.run_until(100)
+		self.assertTrue(channel.can_receive())
+		self.assertTrue(proxy.can_receive())
+		self.assertEqual(proxy.peek(), p)
+		self.assertEqual(channel.receive(), p)
+		self.assertFalse(proxy.can_receive())
+	
+	
+	def test_sata_link_token_bucket(self):
+		s = Scheduler()
+		sys = SpiNNakerSystem(s, 1000)
+		num_channels = 4
+		
+		def send_all(bucket_size):
+			# Send a packet down every channel at once and get the times the packets
+			# entered the delay lines
+			dll = SATALink( s
+			              , num_channels  # num_channels
+			              , 0.5 if bucket_size else 1  # sata_accept_period
+			              , 1  # sata_buffer_length
+			              , 40 # sata_latency
+			              , 10 # silistix_send_cycles
+			              , 5  # silistix_ack_cycles
+			              , bucket_size
+			              )
+			start = s.clock
+			for n in range(num_channels):
+				dll.get_channel_link(n).send(SpiNNakerP2PPacket(sys, n, (0,0), 1))
+			
+			s.run_until(start + 20)
+			return sorted( delay_link.next_arrival_time() - 40 - 1 - start
+			               for delay_link in dll.delay_links)
+		
+		# Keep the clock ticking
+		s.do_every((lambda: None), 1)
+		
+		# One packet per cycle when polling
+		self.assertEqual(send_all(None), [10, 11, 12, 13])
+		
+		# A two packet bucket earning a packet every half cycle lets the handler
+		# run every cycle, handling two packets at a time
+		self.assertEqual(send_all(2), [10, 10, 11, 11])
+		
+		# A bucket smaller than the packets earned between calls to the handler
+		# doesn't limit the bandwidth
+		self.assertEqual(send_all(1), [10, 10, 11, 11])
+	
+	
+	def test_sata_link_credit_latency(self):
+		s = Scheduler()
+		sys = SpiNNakerSystem(s, 1000)
+		
+		def receive_times(sata_credit_latency):
+			# Send three packets down a channel as fast as it allows and get the
+			# times they arrive
+			dll = SATALink( s
+			              , 1  # num_channels
+			              , 1  # sata_accept_period
+			              , 1  # sata_buffer_length
+			              , 40 # sata_latency
+			              , 10 # silistix_send_cycles
+			              , 5  # silistix_ack_cycles
+			              , None # sata_bucket_size
+			              , sata_credit_latency
+			              )
+			channel = dll.get_channel_link(0)
+			start = s.clock
+			times = []
+			num_sent = 0
+			while len(times) < 3:
+				if num_sent < 3 and channel.can_send():
+					channel.send(SpiNNakerP2PPacket(sys, num_sent, (0,0), 1))
+					num_sent += 1
+				if channel.can_receive():
+					channel.receive()
+					times.append(s.clock - start)
+				s.run_until(s.clock + 2)
+				self.assertTrue(s.clock < start + 1000)
+			return times
+		
+		# Keep the clock ticking
+		s.do_every((lambda: None), 1)
+		
+		# The third packet must wait for the credit from the first which, by
+		# default, is returned immediately
+		self.assertEqual(receive_times(0), [61, 76, 102])
+		self.assertEqual(receive_times(30), [61, 76, 132])
 
 
 
@@ -992,6 +1700,51 @@ class RouterTests(unittest.TestCase):
 			
 			# Not emergency routed
 			self.assertFalse(packet.emergency)
+	
+	
+	def test_sleep_on_block(self):
+		# Test that a blocked router sleeps until its output becomes free
+		
+		dud = SpiNNakerP2PPacket( self.system , "Dud" , None , 1)
+		packet = SpiNNakerP2PPacket( self.system , "Example Data" , (2,1) , 32)
+		
+		# Block both the target (east) and emergency (north-east) ports
+		self.in_links[0].send(packet)
+		self.out_links[topology.EAST].send(dud)
+		self.out_links[topology.NORTH_EAST].send(dud)
+		
+		# Something else is going on every cycle
+		self.scheduler.do_every((lambda: None), 1)
+		
+		# The router blocks once and then sleeps through the next routing step
+		self.scheduler.run_until(2*RouterTests.ROUTER_PERIOD + 5)
+		self.assertFalse(self.router.awake)
+		self.assertEqual(self.system.sleeping_routers, set([self.router]))
+		self.assertEqual(packet.wait, 1)
+		
+		# The step slept through is accounted for when the system is caught up...
+		self.system.catch_up(self.scheduler.clock)
+		self.assertEqual(packet.wait, 2)
+		self.assertEqual(self.router.stat_counters["router_cycles"], 2)
+		
+		# ...or the counters are read
+		self.scheduler.run_until(3*RouterTests.ROUTER_PERIOD + 5)
+		self.assertEqual(self.router.counters["router_cycles"], 3)
+		self.assertEqual(self.router.counters["router_blocked_cycles"], 3)
+		self.assertEqual(packet.wait, 3)
+		
+		# Freeing the target port wakes the router which routes the packet at its
+		# next routing step
+		self.out_links[topology.EAST].receive()
+		self.scheduler.run_until(5*RouterTests.ROUTER_PERIOD)
+		self.assertTrue(self.router.awake)
+		self.assertTrue(self.out_links[topology.EAST].can_receive())
+		self.assertEqual(self.out_links[topology.EAST].peek(), packet)
+		self.assertEqual(self.system.sleeping_routers, set())
+		self.assertEqual(self.router.counters["packets_routed"], 1)
+		self.assertEqual(self.router.counters["router_cycles"], 4)
+		self.assertEqual(self.router.counters["router_blocked_cycles"], 3)
+		self.assertEqual(packet.wait, 0)
 
 
 
@@ -1044,6 +1797,36 @@ class SpiNNakerTrafficGeneratorTests(unittest.TestCase):
 		self.assertEqual(tg.counters["generator_dropped_packets"], 0)
 	
 	
+	def test_seed(self):
+		# Seeded generators draw the same traffic as others with the same seed and
+		# position, no matter what else draws random numbers.
+		def simulate(run_seed, position):
+			scheduler = Scheduler()
+			system = SpiNNakerSystem(scheduler, 10)
+			link = BufferLink(scheduler)
+			tg = SpiNNakerTrafficGenerator(scheduler, system, 1, 0.1, link, link,
+			                               seed = run_seed)
+			tg.set_mesh_dimensions(100,100)
+			tg.set_mesh_position(*position)
+			
+			destinations = []
+			def receive():
+				while link.can_receive():
+					packet = link.receive()
+					destinations.append((packet.send_time, packet.destination))
+					# Disturb the random module
+					seed(len(destinations))
+			scheduler.do_every(receive, 1)
+			scheduler.run_until(500)
+			return destinations
+		
+		destinations = simulate(1, (50,50))
+		self.assertTrue(destinations)
+		self.assertEqual(simulate(1, (50,50)), destinations)
+		self.assertNotEqual(simulate(1, (50,51)), destinations)
+		self.assertNotEqual(simulate(2, (50,50)), destinations)
+	
+	
 	def test_normal(self):
 		# Test that packets are generated appropriately when distributing with a
 		# normal distribution.
@@ -1230,10 +2013,64 @@ class SpiNNaker101Tests(unittest.TestCase):
 		self.assertTrue(
 			self.chip.traffic_generator.counters["generator_injected_packets"] < 10)
 		
-		# The router should be very frustrated
+		# The router should be very frustrated (having slept through most of it)
 		self.assertTrue(self.chip.router.counters["router_blocked_cycles"] > 300)
 
 
+	def test_fast_forward(self):
+		# Skipping cycles in which no packets are in flight gives exactly the same
+		# results as simulating every cycle
+		def run(fast_forward):
+			seed(0)
+			scheduler = Scheduler()
+			system = SpiNNakerSystem(scheduler, 1000)
+			chip = SpiNNaker101(scheduler, system, 4, 1, 24, 48, 1, 0.005, None)
+			if fast_forward:
+				scheduler.idle_test = system.is_quiescent
+			scheduler.run_until(5000)
+			
+			return ( chip.router.counters
+			       , chip.router.first_link
+			       , chip.traffic_generator.counters
+			       , [(p.send_time, p.receive_time) for p in system.packets]
+			       , scheduler.clock
+			       )
+		
+		normal = run(False)
+		self.assertEqual(run(True), normal)
+		
+		# Should have been exercised
+		self.assertTrue(normal[2]["generator_packets_received"] > 10)
+
+
+	def test_checkpoint(self):
+		# A simulation restored from a checkpoint continues exactly as the original
+		seed(0)
+		self.chip.traffic_generator.set_packet_prob(0.1)
+		self.scheduler.run_until(500)
+		
+		fd, filename = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			save_checkpoint(filename, (self.scheduler, self.system, self.chip,
+			                           getstate()))
+			
+			self.scheduler.run_until(1000)
+			
+			scheduler, system, chip, random_state = load_checkpoint(filename)
+			setstate(random_state)
+			scheduler.run_until(1000)
+		finally:
+			os.remove(filename)
+		
+		self.assertEqual(scheduler.clock, self.scheduler.clock)
+		self.assertEqual(chip.router.counters, self.chip.router.counters)
+		self.assertEqual(chip.traffic_generator.counters,
+		                 self.chip.traffic_generator.counters)
+		self.assertEqual([(p.send_time, p.receive_time) for p in system.packets],
+		                 [(p.send_time, p.receive_time) for p in self.system.packets])
+
+
 class SpiNNaker103Tests(unittest.TestCase):
 	"""
 	Tests a board in a very vague way...
@@ -1466,5 +2303,145 @@ class SpiNNakerTorusTests(unittest.TestCase):
 					                 other_chip.get_in_link(other_direction))
 
 
+
+
+class ParallelEngineTests(unittest.TestCase):
+	"""
+	Tests the parallel engine simulates a torus exactly as the scheduler does.
+	"""
+	
+	def simulate(self, num_workers):
+		"""
+		Simulate a torus with heavy (seeded) traffic for a short time, in three
+		stretches, with the given number of workers (or just the scheduler if None).
+		Returns the clock, the number of packets in flight, the counters of every
+		chip and the state of every packet at the end of each stretch.
+		"""
+		scheduler = Scheduler()
+		system    = SpiNNakerSystem(scheduler, 50)
+		torus     = SpiNNakerTorus( scheduler, system, 1, 1
+		                         , True # use_sata_links
+		                         , 1, 4, 10 # SATALink
+		                         , 7, 1 # SilistixLink
+		                         , 4 # injection_buffer_length
+		                         , 1, 12, 24 # SpiNNakerRouter
+		                         , 1, 0.5, None, 1234 # SpiNNakerTrafficGenerator
+		                         , None, 10 # SATALink
+		                         )
+		scheduler.idle_test = system.is_quiescent
+		
+		engine = None
+		if num_workers is not None:
+			engine = ParallelEngine(scheduler, system, torus, num_workers)
+		
+		states = []
+		try:
+			for cycle in (20, 35, 50):
+				if engine is None:
+					clock = scheduler.run_until(cycle)
+				else:
+					clock = engine.run_until(cycle)
+				
+				# Account for the routing steps of sleeping routers
+				system.catch_up(cycle)
+				
+				counters = dict(
+					(chip.get_mesh_position(), (dict(chip.router.counters),
+					                            dict(chip.traffic_generator.counters)))
+					for board in torus.boards.itervalues()
+					for chip in board.chips.itervalues())
+				packets = [ ( packet.id, packet.source, packet.destination
+				            , packet.send_time, packet.receive_time, packet.drop_time
+				            , packet.drop_location, list(packet.emergency_time)
+				            , packet.wait, packet.distance)
+				            for packet in system.packets
+				          ]
+				states.append((clock, system.packets_in_flight, counters, packets))
+		finally:
+			if engine is not None:
+				engine.close()
+		
+		return states
+	
+	
+	def test_parallel(self):
+		expected = self.simulate(None)
+		
+		# Packets should have been delivered and some left in flight between the
+		# stretches
+		self.assertTrue(any(packet[4] is not None for packet in expected[-1][3]))
+		self.assertTrue(all(state[1] for state in expected[:-1]))
+		
+		for num_workers in (1, 2, 3):
+			self.assertEqual(self.simulate(num_workers), expected)
+	
+	
+	def run_simulation(self, num_workers):
+		"""
+		Run a Simulation with its default configuration (but for a seed) for 250
+		cycles with the given number of workers (or None). Returns the clocks and
+		numbers of packets received seen by a measurer and the state of every
+		packet at the end.
+		"""
+		class ReceivedSimulation(Simulation):
+			def measurement_received(self, datafile):
+				self.received = []
+				yield
+				try:
+					while True:
+						self.received.append((self.scheduler.clock, sum(
+							chip.traffic_generator.counters["generator_packets_received"]
+							for board in self.torus.boards.itervalues()
+							for chip in board.chips.itervalues())))
+						yield
+				except Simulation.StopExperiment:
+					pass
+		
+		old_config = ( Simulation.SEED
+		             , Simulation.NUM_WORKERS
+		             , Simulation.SATA_CREDIT_LATENCY
+		             )
+		directory = tempfile.mkdtemp()
+		
+		# Keep the console quiet
+		stderr, sys.stderr = sys.stderr, StringIO()
+		try:
+			Simulation.SEED        = 1234
+			Simulation.NUM_WORKERS = num_workers
+			if num_workers is None:
+				# The credit latency used by default when simulating in parallel
+				Simulation.SATA_CREDIT_LATENCY = Simulation.SATA_LATENCY
+			
+			simulation = ReceivedSimulation(os.path.join(directory, ""))
+			self.assertTrue(simulation.run(250))
+		finally:
+			(Simulation.SEED, Simulation.NUM_WORKERS,
+			 Simulation.SATA_CREDIT_LATENCY) = old_config
+			sys.stderr = stderr
+			shutil.rmtree(directory)
+		
+		packets = [ ( packet.id, packet.source, packet.destination
+		            , packet.send_time, packet.receive_time, packet.drop_time
+		            , packet.wait, packet.distance)
+		            for packet in simulation.system.packets
+		          ]
+		return simulation.received, packets
+	
+	
+	def test_simulation(self):
+		# The default configuration can be simulated in parallel with the same
+		# results, the measurers seeing the model every PARALLEL_INTERVAL cycles
+		# once they have been simulated
+		received, packets = self.run_simulation(None)
+		self.assertTrue(any(packet[4] is not None for packet in packets))
+		
+		interval = Simulation.PARALLEL_INTERVAL
+		self.assertEqual(self.run_simulation(3),
+		                 ([ (clock - 1, num) for clock, num in received
+		                    if clock in (interval + 1, 2 * interval + 1) ]
+		                  + [(249, sum(packet[4] is not None for packet in packets))],
+		                  packets))
+
+
 if __name__=="__main__":
 	unittest.main()
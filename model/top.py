@@ -38,6 +38,7 @@ class SpiNNaker101(object):
 	            , core_period            # SpiNNakerTrafficGenerator
 	            , packet_prob            # SpiNNakerTrafficGenerator
 	            , distance_std = None    # SpiNNakerTrafficGenerator
+	            , seed = None            # SpiNNakerTrafficGenerator
 	            ):
 		"""
 		injection_buffer_length is the number of packets that can be buffered internally
@@ -50,6 +51,7 @@ class SpiNNaker101(object):
 		core_period see SpiNNakerTrafficGenerator
 		packet_prob see SpiNNakerTrafficGenerator
 		distance_std see SpiNNakerTrafficGenerator
+		seed see SpiNNakerTrafficGenerator
 		"""
 		
 		self.scheduler = scheduler
@@ -70,6 +72,7 @@ class SpiNNaker101(object):
 		                                                  , injection_link
 		                                                  , exit_link
 		                                                  , distance_std
+		                                                  , seed
 		                                                  )
 		
 		self.router = SpiNNakerRouter( self.scheduler
@@ -189,6 +192,7 @@ class SpiNNaker103(object):
 	            , core_period             # SpiNNakerTrafficGenerator
 	            , packet_prob             # SpiNNakerTrafficGenerator
 	            , distance_std = None     # SpiNNakerTrafficGenerator
+	            , seed = None             # SpiNNakerTrafficGenerator
 	            ):
 		"""
 		link_send_cycles see SilistixLink
@@ -203,6 +207,7 @@ class SpiNNaker103(object):
 		core_period see SpiNNakerTrafficGenerator
 		packet_prob see SpiNNakerTrafficGenerator
 		distance_std see SpiNNakerTrafficGenerator
+		seed see SpiNNakerTrafficGenerator
 		"""
 		
 		self.scheduler               = scheduler
@@ -225,6 +230,7 @@ class SpiNNaker103(object):
 			                                   , core_period
 			                                   , packet_prob
 			                                   , distance_std
+			                                   , seed
 			                                   )
 		# Create the chips in a hexagonal pattern
 		for position in topology.hexagon(4):
@@ -402,6 +408,9 @@ class SpiNNakerTorus(object):
 	            , core_period             # SpiNNakerTrafficGenerator
 	            , packet_prob             # SpiNNakerTrafficGenerator
 	            , distance_std = None     # SpiNNakerTrafficGenerator
+	            , seed = None             # SpiNNakerTrafficGenerator
+	            , sata_bucket_size = None # SATALink
+	            , sata_credit_latency = 0 # SATALink
 	            ):
 		"""
 		width is the number of three-board board-sets wide the system will be.
@@ -427,6 +436,10 @@ class SpiNNakerTorus(object):
 		core_period see SpiNNakerTrafficGenerator
 		packet_prob see SpiNNakerTrafficGenerator
 		distance_std see SpiNNakerTrafficGenerator
+		seed see SpiNNakerTrafficGenerator
+		
+		sata_bucket_size see SATALink
+		sata_credit_latency see SATALink
 		"""
 		
 		self.scheduler               = scheduler
@@ -441,6 +454,10 @@ class SpiNNakerTorus(object):
 		# coordinate system.
 		self.boards = { }
 		
+		# A list of (sending_board_coords, receiving_board_coords, SATALink) for
+		# every S-ATA link between boards (if used)
+		self.sata_links = [ ]
+		
 		# The size of the mesh of chips: twelve chips per board set
 		mesh_dimensions = (self.width * 12, self.height * 12)
 		
@@ -463,6 +480,7 @@ class SpiNNakerTorus(object):
 					                    , core_period
 					                    , packet_prob
 					                    , distance_std
+					                    , seed
 					                    )
 					
 					# The coordinates of a board within the set of boards
@@ -513,6 +531,8 @@ class SpiNNakerTorus(object):
 					                  , sata_latency
 					                  , silistix_send_cycles
 					                  , silistix_ack_cycles
+					                  , sata_bucket_size
+					                  , sata_credit_latency
 					                  )
 					# From other_board to board
 					out_link = SATALink( self.scheduler
@@ -522,8 +542,13 @@ class SpiNNakerTorus(object):
 					                   , sata_latency
 					                   , silistix_send_cycles
 					                   , silistix_ack_cycles
+					                   , sata_bucket_size
+					                   , sata_credit_latency
 					                   )
 					
+					self.sata_links.append((other_coords, board_coords, in_link))
+					self.sata_links.append((board_coords, other_coords, out_link))
+					
 					# Link up each of the channels on this edge in both directions
 					for channel in range(8):
 						in_channel  = in_link.get_channel_link(channel)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+A bounded trace of recent simulation events for post-mortem debugging.
+"""
+
+
+class Trace(object):
+	"""
+	A ring buffer holding the last length events recorded by components via
+	Scheduler.trace_event(). Each event is a (clock, owner, kind, packet_id)
+	tuple where owner is the component which recorded it.
+	"""
+	
+	def __init__(self, length):
+		self.length = length
+		
+		self.events = [None] * length
+		
+		# The index at which the next event will be recorded
+		self.next_index = 0
+		
+		# The total number of events recorded (including those overwritten)
+		self.num_recorded = 0
+	
+	
+	def record(self, clock, owner, kind, packet_id = None):
+		"""
+		Record an event, overwriting the oldest if the buffer is full.
+		"""
+		self.events[self.next_index] = (clock, owner, kind, packet_id)
+		self.next_index += 1
+		if self.next_index == self.length:
+			self.next_index = 0
+		self.num_recorded += 1
+	
+	
+	def get_events(self):
+		"""
+		Get the events in the buffer, oldest first.
+		"""
+		if self.num_recorded < self.length:
+			return self.events[:self.next_index]
+		else:
+			return self.events[self.next_index:] + self.events[:self.next_index]
+	
+	
+	def dump(self, f):
+		"""
+		Write the events in the buffer to the file f, oldest first. Owners are
+		described by their class and mesh position (if they have one).
+		"""
+		f.write("#clock owner position kind packet_id\n")
+		for clock, owner, kind, packet_id in self.get_events():
+			f.write("%d %s %s %s %s\n"%(
+				clock,
+				type(owner).__name__,
+				"%d,%d"%owner.mesh_position if hasattr(owner, "mesh_position") else "-",
+				kind,
+				"-" if packet_id is None else packet_id,
+			))
@@ -8,7 +8,9 @@ This is a mess! Sorry!
 
 usage:
 
-  pypy packet_drop_areas.py [cycles] [width] [height] [exp_no]
+  pypy packet_drop_areas.py [--resume] [cycles] [width] [height] [exp_no]
+
+--resume continues from the last checkpoint of the same experiment (if any)
 
 cycles is the number of cycles to run for
 
@@ -22,6 +24,13 @@ exp_no is:
 3: Run with slow spinn-links without emergency routing
 4: Run with only silistix links
 5: Run with only silistix links without emergency routing
+6: Run 0 and 1 as forks of a shared warm-up
+7: Run 2 and 3 as forks of a shared warm-up
+8: Run 4 and 5 as forks of a shared warm-up
+
+The forked experiments simulate the first quarter of the run (with emergency
+routing) once and then fork a process for each variant. Emergency routing is
+disabled only after the warm-up in the forked "no emergency" variants.
 
 produces results files pda_*.log
 
@@ -40,8 +49,8 @@ class PacketDropAreasExperiment(Simulation):
 	Experiment on the effects of packets 
 	"""
 	
-	def __init__(self, resultfile_prefix = "pda_"):
-		Simulation.__init__(self, resultfile_prefix)
+	def __init__(self, resultfile_prefix = "pda_", resume = False):
+		Simulation.__init__(self, resultfile_prefix, resume)
 	
 	
 	def measurement_average_packet_distance(self, datafile):
@@ -49,7 +58,8 @@ class PacketDropAreasExperiment(Simulation):
 		Measure the time/hops taken by packets around the network
 		"""
 		# Set up
-		datafile.write("shortest_hops actual_hops time\n")
+		if not self.resumed:
+			datafile.write("shortest_hops actual_hops time\n")
 		
 		yield
 		
@@ -86,16 +96,17 @@ class PacketDropAreasExperiment(Simulation):
 		cores to speed up data collection.
 		"""
 		# Set up
-		datafile.write("#x y"\
-		               " packets_routed"\
-		               " packet_emergency_routed"\
-		               " router_idle_cycles"\
-		               " router_blocked_cycles"\
-		               " router_packet_timeout"\
-		               " generator_injected_packets"\
-		               " generator_dropped_packets"\
-		               " generator_packets_received"\
-		               "\n")
+		if not self.resumed:
+			datafile.write("#x y"\
+			               " packets_routed"\
+			               " packet_emergency_routed"\
+			               " router_idle_cycles"\
+			               " router_blocked_cycles"\
+			               " router_packet_timeout"\
+			               " generator_injected_packets"\
+			               " generator_dropped_packets"\
+			               " generator_packets_received"\
+			               "\n")
 		
 		yield
 		
@@ -141,6 +152,10 @@ if __name__=="__main__":
 	# seq 0 5 | xargs -n1 -P2 time pypy packet_drop_areas.py 10000
 	# To execute all four experiments in parallel (on -P[cores] cores).
 	
+	resume = "--resume" in sys.argv
+	if resume:
+		sys.argv.remove("--resume")
+	
 	cycles     = int(sys.argv[1])
 	width      = int(sys.argv[2])
 	height     = int(sys.argv[3])
@@ -159,7 +174,7 @@ if __name__=="__main__":
 		Simulation.WAIT_BEFORE_EMERGENCY = orig_wait_before_emergency
 		Simulation.WAIT_BEFORE_DROP = orig_wait_before_drop
 		Simulation.USE_SATA_LINKS = True
-		s = PacketDropAreasExperiment(prefix)
+		s = PacketDropAreasExperiment(prefix, resume)
 		s.run(cycles)
 	
 	# Run once without emergency routing
@@ -167,7 +182,7 @@ if __name__=="__main__":
 		Simulation.WAIT_BEFORE_EMERGENCY = 1000000
 		Simulation.WAIT_BEFORE_DROP = 1000000
 		Simulation.USE_SATA_LINKS = True
-		s = PacketDropAreasExperiment("%sno_emg_"%prefix)
+		s = PacketDropAreasExperiment("%sno_emg_"%prefix, resume)
 		s.run(cycles)
 	
 	# Run with extreme spinn delay
@@ -177,7 +192,7 @@ if __name__=="__main__":
 		Simulation.USE_SATA_LINKS = True
 		Simulation.SATA_LATENCY = 200
 		Simulation.SATA_BUFFER_LENGTH = 200
-		s = PacketDropAreasExperiment("%sextreme_"%prefix)
+		s = PacketDropAreasExperiment("%sextreme_"%prefix, resume)
 		s.run(cycles)
 	
 	# Run once without emergency routing
@@ -187,7 +202,7 @@ if __name__=="__main__":
 		Simulation.USE_SATA_LINKS = True
 		Simulation.SATA_LATENCY = 200
 		Simulation.SATA_BUFFER_LENGTH = 200
-		s = PacketDropAreasExperiment("%sextreme_no_emg_"%prefix)
+		s = PacketDropAreasExperiment("%sextreme_no_emg_"%prefix, resume)
 		s.run(cycles)
 	
 	# Without spinnlinks!
@@ -197,7 +212,7 @@ if __name__=="__main__":
 		Simulation.WAIT_BEFORE_EMERGENCY = orig_wait_before_emergency
 		Simulation.WAIT_BEFORE_DROP = orig_wait_before_drop
 		Simulation.USE_SATA_LINKS = False
-		s = PacketDropAreasExperiment("%sno_spinn_"%prefix)
+		s = PacketDropAreasExperiment("%sno_spinn_"%prefix, resume)
 		s.run(cycles)
 	
 	# Run once without emergency routing
@@ -205,8 +220,49 @@ if __name__=="__main__":
 		Simulation.WAIT_BEFORE_EMERGENCY = 1000000
 		Simulation.WAIT_BEFORE_DROP = 1000000
 		Simulation.USE_SATA_LINKS = False
-		s = PacketDropAreasExperiment("%sno_emg_no_spinn_"%prefix)
+		s = PacketDropAreasExperiment("%sno_emg_no_spinn_"%prefix, resume)
 		s.run(cycles)
 	
-	exps = [normal, normal_no_emergency, extreme, extreme_no_emergency, no_spinn, no_spinn_no_emergency]
+	# Forked pairs of the above which share a warm-up period
+	
+	warmup_cycles = cycles / 4
+	
+	def unchanged(s):
+		pass
+	
+	def no_emergency(s):
+		for board in s.torus.boards.itervalues():
+			for chip in board.chips.itervalues():
+				chip.router.wait_before_emergency = 1000000
+				chip.router.wait_before_drop      = 1000000
+	
+	def forked(use_sata_links, variants):
+		Simulation.WAIT_BEFORE_EMERGENCY = orig_wait_before_emergency
+		Simulation.WAIT_BEFORE_DROP = orig_wait_before_drop
+		Simulation.USE_SATA_LINKS = use_sata_links
+		# Only the variants are resumed: the warm-up's prefix is shared with
+		# experiment 0 whose checkpoint must not be picked up.
+		s = PacketDropAreasExperiment(prefix)
+		if not s.run_forked(warmup_cycles, cycles, variants, resume = resume):
+			sys.exit(1)
+	
+	def normal_forked():
+		forked(True, [ ("%sforked_"%prefix, unchanged)
+		             , ("%sforked_no_emg_"%prefix, no_emergency)
+		             ])
+	
+	def extreme_forked():
+		Simulation.SATA_LATENCY = 200
+		Simulation.SATA_BUFFER_LENGTH = 200
+		forked(True, [ ("%sforked_extreme_"%prefix, unchanged)
+		             , ("%sforked_extreme_no_emg_"%prefix, no_emergency)
+		             ])
+	
+	def no_spinn_forked():
+		forked(False, [ ("%sforked_no_spinn_"%prefix, unchanged)
+		              , ("%sforked_no_emg_no_spinn_"%prefix, no_emergency)
+		              ])
+	
+	exps = [normal, normal_no_emergency, extreme, extreme_no_emergency, no_spinn, no_spinn_no_emergency,
+	        normal_forked, extreme_forked, no_spinn_forked]
 	exps[experiment]()
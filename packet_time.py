@@ -8,7 +8,9 @@ This is a mess! Sorry!
 
 usage:
 
-  pypy packet_time.py [steps] [width] [height] [source_rate] [other_rate] [sata_latency]
+  pypy packet_time.py [--resume] [steps] [width] [height] [source_rate] [other_rate] [sata_latency]
+
+--resume continues from the last checkpoint of the same experiment (if any)
 
 steps is the number of cycles to simulate
 
@@ -33,6 +35,28 @@ import model.topology as topology
 
 from experiment import Simulation
 
+
+class ShuffledLocations(object):
+	"""
+	Yields random locations from a list but ensures every location is hit. (An
+	object rather than a generator so that it can be checkpointed.)
+	"""
+	
+	def __init__(self, locations):
+		self.locations = list(locations)
+		self.index     = len(self.locations)
+	
+	
+	def next(self):
+		if self.index == len(self.locations):
+			shuffle(self.locations)
+			self.index = 0
+		
+		location = self.locations[self.index]
+		self.index += 1
+		return location
+
+
 class PacketTimeExperiment(Simulation):
 	"""
 	Experiment on the effects of packets 
@@ -43,12 +67,13 @@ class PacketTimeExperiment(Simulation):
 	            , source_packet_prob
 	            , other_packet_prob
 	            , resultfile_prefix = "pte_"
+	            , resume = False
 	            ):
 		self.source_node        = source_node
 		self.source_packet_prob = source_packet_prob
 		self.other_packet_prob  = other_packet_prob
 		
-		Simulation.__init__(self, resultfile_prefix)
+		Simulation.__init__(self, resultfile_prefix, resume)
 	
 	
 	def measurement_packets_from_single_source(self, datafile):
@@ -57,29 +82,24 @@ class PacketTimeExperiment(Simulation):
 		various destinations. This core is set to broadcast more packets than other
 		cores to speed up data collection.
 		"""
-		# Set up
-		datafile.write("#x y shortest_path"\
-		               " distance distance_min distance_max"\
-		               " time time_min time_max\n")
-		
-		# A generator which yields random locations in the grid but ensures every
-		# location is hit
-		def generate_packets():
-			locations = list(product(range(12*self.WIDTH), range(12*self.HEIGHT)))
-			while True:
-				shuffle(locations)
-				for location in locations:
-					yield location
-		packet_gen = generate_packets()
-		
-		# Set the packet generator rates
-		for board in self.torus.boards.itervalues():
-			for chip in board.chips.itervalues():
-				if chip.traffic_generator.mesh_position == self.source_node:
-					chip.traffic_generator.packet_prob = self.source_packet_prob
-					chip.traffic_generator.get_random_dest = packet_gen.next
-				else:
-					chip.traffic_generator.packet_prob = self.other_packet_prob
+		# Set up (already done if the model was restored from a checkpoint)
+		if not self.resumed:
+			datafile.write("#x y shortest_path"\
+			               " distance distance_min distance_max"\
+			               " time time_min time_max\n")
+			
+			# Random locations in the grid which ensure every location is hit
+			packet_gen = ShuffledLocations(product(range(12*self.WIDTH),
+			                                       range(12*self.HEIGHT)))
+			
+			# Set the packet generator rates
+			for board in self.torus.boards.itervalues():
+				for chip in board.chips.itervalues():
+					if chip.traffic_generator.mesh_position == self.source_node:
+						chip.traffic_generator.set_packet_prob(self.source_packet_prob)
+						chip.traffic_generator.get_random_dest = packet_gen.next
+					else:
+						chip.traffic_generator.set_packet_prob(self.other_packet_prob)
 		
 		yield
 		
@@ -148,10 +168,14 @@ class PacketTimeExperiment(Simulation):
 
 if __name__=="__main__":
 	# Usage:
-	# pypy packet_time.py [steps] [width] [height] [source_rate] [other_rate] [sata_latency]
+	# pypy packet_time.py [--resume] [steps] [width] [height] [source_rate] [other_rate] [sata_latency]
 	import sys
 	sys.argv.pop(0)
 	
+	resume = "--resume" in sys.argv
+	if resume:
+		sys.argv.remove("--resume")
+	
 	steps             = int(sys.argv.pop(0))
 	
 	Simulation.WIDTH  = int(sys.argv.pop(0))
@@ -173,5 +197,5 @@ if __name__=="__main__":
 	
 	s = PacketTimeExperiment(((12*Simulation.WIDTH)/2,(12*Simulation.HEIGHT)/2),
 	                         source_packet_prob, other_packet_prob,
-	                         prefix)
+	                         prefix, resume)
 	s.run(steps)
@@ -8,9 +8,9 @@ This is a mess! Sorry!
 
 usage:
 
-  pypy packets_in_transit.py
+  pypy packets_in_transit.py [--resume]
 
-(no arguments)
+--resume continues from the last checkpoint (if any)
 
 produces files pit_*.log
 
@@ -27,8 +27,8 @@ class PacketsInTransitExperiment(Simulation):
 	Just a place to put the packets in-transit experiment...
 	"""
 	
-	def __init__(self, resultfile_prefix = "pit_"):
-		Simulation.__init__(self, resultfile_prefix)
+	def __init__(self, resultfile_prefix = "pit_", resume = False):
+		Simulation.__init__(self, resultfile_prefix, resume)
 	
 	
 	def measurement_packets_in_transit(self, datafile):
@@ -36,10 +36,11 @@ class PacketsInTransitExperiment(Simulation):
 		Measure the number of packets in the system
 		"""
 		# Set up
-		datafile.write("#clock"\
-		               " generator_injected_packets"\
-		               " generator_dropped_packets"\
-		               " generator_packets_received\n") 
+		if not self.resumed:
+			datafile.write("#clock"\
+			               " generator_injected_packets"\
+			               " generator_dropped_packets"\
+			               " generator_packets_received\n") 
 		
 		all_cores_counters = []
 		for board in self.torus.boards.itervalues():
@@ -48,16 +49,17 @@ class PacketsInTransitExperiment(Simulation):
 		
 		yield
 		
-		# Measure the number of packets about once every clock cycle
+		# Measure the number of packets once every clock cycle (or once per span of
+		# idle cycles skipped when fast-forwarding, in which nothing changes)
 		try:
 			while True:
-				if (yield):
-					datafile.write("%d %d %d %d\n"%(
-						self.scheduler.clock,
-						sum(c["generator_injected_packets"] for c in all_cores_counters),
-						sum(c["generator_dropped_packets"] for c in all_cores_counters),
-						sum(c["generator_packets_received"] for c in all_cores_counters),
-					))
+				yield
+				datafile.write("%d %d %d %d\n"%(
+					self.scheduler.clock,
+					sum(c["generator_injected_packets"] for c in all_cores_counters),
+					sum(c["generator_dropped_packets"] for c in all_cores_counters),
+					sum(c["generator_packets_received"] for c in all_cores_counters),
+				))
 		except Simulation.StopExperiment:
 			pass
 			# Nothing to write at the end of simulation
@@ -65,6 +67,8 @@ class PacketsInTransitExperiment(Simulation):
 
 
 if __name__=="__main__":
-	s = PacketsInTransitExperiment()
+	import sys
+	
+	s = PacketsInTransitExperiment(resume = "--resume" in sys.argv)
 	s.run(10000)
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmarks for the scheduler.
+
+usage:
+
+  pypy scheduler_benchmark.py [steps]
+
+steps is the number of tasks to execute in each benchmark (default 200000).
+
+Each benchmark keeps a number of tasks alive which reschedule themselves with a
+random delay. The spread of delays determines the number of distinct future
+clock values waiting in the postponed queue while a delay of exactly one cycle
+puts every task in the same cycle. Delays beyond the TimingWheelScheduler's
+wheel size (256 cycles by default) fall back on its overflow heap.
+
+The DictScanScheduler scans every key once per cycle so the heap only pays off
+when there are many keys for each task executed. With 1000 tasks and delays of
+100-200 cycles there are at most 101 keys and ten tasks due in each cycle, so
+the scan costs little and the heap shows no gain. The 2304-task workloads model
+the traffic generators' wake-up timers on a 4x4 board-set torus (S-ATA latency
+150). These averaged about 100 postponed keys at a packet probability of 0.05
+and about 1450 at 0.001. Only the latter, sparse case benefits: it runs 3-4x
+faster than the dictionary scan.
+"""
+
+import sys
+import time
+
+from random import Random
+
+from collections import defaultdict
+
+from model.scheduler import Scheduler
+from model.scheduler import TimingWheelScheduler
+
+
+class DictScanScheduler(Scheduler):
+	"""
+	The original scheduler implementation: list ready/inactive queues which are
+	popped from the front and a defaultdict of postponed task lists whose
+	smallest key is found by scanning every key each time the clock advances.
+	Kept as a reference point for the benchmarks.
+	"""
+	
+	def __init__(self):
+		Scheduler.__init__(self)
+		self.ready     = []
+		self.inactive  = []
+		self.postponed = defaultdict(list)
+	
+	
+	def do_later(self, c, delay = 0):
+		assert(delay >= 0)
+		
+		if delay == 0:
+			self.inactive.append(c)
+		else:
+			self.postponed[self.clock + delay].append(c)
+	
+	
+	def run(self):
+		while self.ready or self.inactive or self.postponed:
+			while self.ready or self.inactive:
+				while self.ready:
+					self.ready.pop(0)()
+					yield self.clock
+				
+				if not self.ready:
+					self.ready    = self.inactive
+					self.inactive = []
+			
+			if self.postponed:
+				self.clock = min(self.postponed.iterkeys())
+				self.ready = self.postponed.pop(self.clock)
+			else:
+				return
+
+
+def run_benchmark(scheduler_class, num_tasks, min_delay, max_delay, steps):
+	"""
+	Time how long the given scheduler takes to execute the given number of steps
+	with num_tasks tasks which each reschedule themselves with a delay between
+	min_delay and max_delay cycles. Returns the time taken in seconds.
+	"""
+	scheduler = scheduler_class()
+	
+	# A fixed seed so that every scheduler sees the same workload
+	rng = Random(0)
+	
+	def make_task():
+		def task():
+			scheduler.do_later(task, rng.randint(min_delay, max_delay))
+		return task
+	
+	for _ in range(num_tasks):
+		scheduler.do_later(make_task(), rng.randint(min_delay, max_delay))
+	
+	start = time.time()
+	for step, _ in enumerate(scheduler.run()):
+		if step >= steps:
+			break
+	return time.time() - start
+
+
+if __name__=="__main__":
+	steps = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	
+	# (num_tasks, min_delay, max_delay)
+	workloads = [ (20000, 1,   1)
+	            , (100,   1,   20)
+	            , (1000,  100, 200)
+	            , (5000,  100, 1000)
+	            , (20000, 100, 2000)
+	            , (2304,  1,   110)  # 4x4 board-sets, ~100 keys
+	            , (2304,  1,   2000) # 4x4 board-sets, ~1450 keys
+	            ]
+	
+	schedulers = [DictScanScheduler, Scheduler, TimingWheelScheduler]
+	
+	print "#tasks delays %s"%(" ".join(s.__name__ for s in schedulers))
+	for num_tasks, min_delay, max_delay in workloads:
+		times = [run_benchmark(s, num_tasks, min_delay, max_delay, steps)
+		         for s in schedulers]
+		print "%d %d-%d %s"%(num_tasks, min_delay, max_delay,
+		                     " ".join("%0.3fs"%t for t in times))